@@ -6,16 +6,46 @@ A tool to change database and phpMyAdmin ports and migrate data from Marzban to
 Power By: ASiSSK
 """
 
+import argparse
+import atexit
+import contextlib
 import re
 import os
-import subprocess
 import sys
+import tempfile
+import threading
 import time
 import json
+import math
 import datetime
-import pymysql
-from typing import Dict, Any, Optional, Tuple, List
-from dotenv import dotenv_values
+import functools
+import importlib.util
+from collections import defaultdict
+from concurrent.futures import ThreadPoolExecutor
+from itertools import islice
+from typing import Dict, Any, Optional, Tuple, List, Iterable, Set
+try:
+    # Gives input() prompts line editing and history where available
+    import readline
+except ImportError:
+    pass
+try:
+    # Optional faster JSON for the per-row settings columns; the stdlib json module is the fallback
+    import orjson
+except ImportError:
+    orjson = None
+
+# Idle database connections kept between migrations run from the same menu session, keyed by pool_key(config)
+CONNECTION_POOL: Dict[tuple, list] = defaultdict(list)
+CONNECTION_POOL_LOCK = threading.Lock()
+# Idle connections kept per config; enough for the parallel workers, extra ones are closed on release
+CONNECTION_POOL_MAX_IDLE = 4
+
+# Set once check_dependencies() has found every required package
+_DEPS_OK = False
+
+# Imported by load_pymysql() when a migration starts; the menu and the port-change path never need it
+pymysql = None
 
 # ANSI color codes
 CYAN = "\033[36m"
@@ -30,88 +60,346 @@ PASARGUARD_ENV_PATH = "/opt/pasarguard/.env"
 DOCKER_COMPOSE_FILE_PATH = "/opt/pasarguard/docker-compose.yml"
 XRAY_CONFIG_PATH = "/var/lib/marzban/xray_config.json"
 
+def pause_seconds(value: str) -> float:
+    """Parse a pause length; nan, inf and negative values would make time.sleep() fail mid-menu."""
+    seconds = float(value)
+    if not math.isfinite(seconds) or seconds < 0:
+        raise ValueError(f"not a finite, non-negative number of seconds: {value}")
+    return seconds
+
+# Seconds to pause after the port-change, file and invalid-choice messages of the menu (MARZ_PAUSE=0.5 or
+# --verbose-pause 0.5); off by default. The migration itself never pauses.
+try:
+    VERBOSE_PAUSE = pause_seconds(os.environ.get("MARZ_PAUSE", "0"))
+except ValueError:
+    VERBOSE_PAUSE = 0.0
+
+# Rows sent per multi-row INSERT (keeps each statement well under max_allowed_packet)
+BATCH_SIZE = 5000
+
+# Upper bound for one rewritten multi-row INSERT (pymysql splits at 1MB by default). The server's
+# max_allowed_packet can be lower (4MB by default on MySQL 5.7), so stmt_length_limit() clamps it to that.
+MAX_STMT_LENGTH = 16 * 1024 * 1024
+
+# Connection options shared by both databases: large packets on the client side (this does not raise the
+# server's own max_allowed_packet), explicit transactions and
+# generous network timeouts so long batches are not cut off mid-transfer
+BULK_CONNECT_OPTIONS = {
+    "charset": "utf8mb4",
+    "autocommit": False,
+    "max_allowed_packet": 256 * 1024 * 1024,
+    "init_command": "SET SESSION net_write_timeout=600, net_read_timeout=600",
+}
+
+# Minimal Pasarguard schema created when a table is missing, in foreign key dependency order
+PASARGUARD_TABLES: List[Tuple[str, str]] = [
+    ("groups", """
+        CREATE TABLE `groups` (
+            id INT PRIMARY KEY, name VARCHAR(255) NOT NULL, is_disabled BOOLEAN DEFAULT FALSE
+        )
+    """),
+    ("core_configs", """
+        CREATE TABLE `core_configs` (
+            id INT PRIMARY KEY, created_at DATETIME NOT NULL, name VARCHAR(255) NOT NULL,
+            config JSON NOT NULL, exclude_inbound_tags TEXT, fallbacks_inbound_tags TEXT
+        )
+    """),
+    ("admins", """
+        CREATE TABLE admins (
+            id INT PRIMARY KEY, username VARCHAR(255) NOT NULL, hashed_password TEXT NOT NULL,
+            created_at DATETIME NOT NULL, is_sudo BOOLEAN DEFAULT FALSE,
+            password_reset_at DATETIME, telegram_id BIGINT, discord_webhook TEXT
+        )
+    """),
+    ("inbounds", "CREATE TABLE inbounds (id INT PRIMARY KEY, tag VARCHAR(255) NOT NULL)"),
+    ("inbounds_groups_association", """
+        CREATE TABLE inbounds_groups_association (
+            inbound_id INT, group_id INT, PRIMARY KEY (inbound_id, group_id),
+            FOREIGN KEY (inbound_id) REFERENCES inbounds(id),
+            FOREIGN KEY (group_id) REFERENCES `groups`(id)
+        )
+    """),
+    ("hosts", """
+        CREATE TABLE hosts (
+            id INT PRIMARY KEY, remark VARCHAR(255), address VARCHAR(255), port INT,
+            inbound_tag VARCHAR(255), sni TEXT, host TEXT, security VARCHAR(50), alpn TEXT,
+            fingerprint TEXT, allowinsecure BOOLEAN, is_disabled BOOLEAN, path TEXT,
+            random_user_agent BOOLEAN, use_sni_as_host BOOLEAN, priority INT DEFAULT 0,
+            http_headers TEXT, transport_settings TEXT, mux_settings TEXT,
+            noise_settings TEXT, fragment_settings TEXT, status VARCHAR(50)
+        )
+    """),
+    ("nodes", """
+        CREATE TABLE nodes (
+            id INT PRIMARY KEY, name VARCHAR(255) NOT NULL, address VARCHAR(255) NOT NULL,
+            port INT, status VARCHAR(50), last_status_change DATETIME, message TEXT,
+            created_at DATETIME NOT NULL, uplink BIGINT, downlink BIGINT,
+            xray_version VARCHAR(50), usage_coefficient FLOAT, node_version VARCHAR(50),
+            connection_type VARCHAR(50), server_ca TEXT, keep_alive BOOLEAN,
+            max_logs INT, core_config_id INT, gather_logs BOOLEAN,
+            FOREIGN KEY (core_config_id) REFERENCES `core_configs`(id)
+        )
+    """),
+    ("users", """
+        CREATE TABLE users (
+            id INT PRIMARY KEY, username VARCHAR(255) NOT NULL, status VARCHAR(50),
+            used_traffic BIGINT, data_limit BIGINT, created_at DATETIME NOT NULL,
+            admin_id INT, data_limit_reset_strategy VARCHAR(50), sub_revoked_at DATETIME,
+            note TEXT, online_at DATETIME, edit_at DATETIME, on_hold_timeout DATETIME,
+            on_hold_expire_duration INT, auto_delete_in_days INT,
+            last_status_change DATETIME, expire DATETIME, proxy_settings JSON
+        )
+    """),
+]
+
+# Pasarguard column order used by the migration INSERTs (the first column is the primary key)
+ADMIN_COLUMNS = (
+    "id", "username", "hashed_password", "created_at", "is_sudo", "password_reset_at", "telegram_id", "discord_webhook",
+)
+HOST_COLUMNS = (
+    "id", "remark", "address", "port", "inbound_tag", "sni", "host", "security", "alpn",
+    "fingerprint", "allowinsecure", "is_disabled", "path", "random_user_agent",
+    "use_sni_as_host", "priority", "http_headers", "transport_settings",
+    "mux_settings", "noise_settings", "fragment_settings", "status",
+)
+NODE_COLUMNS = (
+    "id", "name", "address", "port", "status", "last_status_change", "message",
+    "created_at", "uplink", "downlink", "xray_version", "usage_coefficient",
+    "node_version", "connection_type", "server_ca", "keep_alive", "max_logs",
+    "core_config_id", "gather_logs",
+)
+USER_COLUMNS = (
+    "id", "username", "status", "used_traffic", "data_limit", "created_at",
+    "admin_id", "data_limit_reset_strategy", "sub_revoked_at", "note",
+    "online_at", "edit_at", "on_hold_timeout", "on_hold_expire_duration",
+    "auto_delete_in_days", "last_status_change", "expire", "proxy_settings",
+)
+
+# Tables emptied by --fresh, children before the tables they reference
+FRESH_TRUNCATE_ORDER = ("users", "nodes", "hosts", "inbounds_groups_association", "inbounds", "admins")
+# Bulk-loaded tables whose non-unique secondary indexes --fresh drops and rebuilds once after the load
+FRESH_DEFERRED_INDEX_TABLES = ("hosts", "nodes", "users")
+
+# Marzban proxy type -> the fields Pasarguard keeps in users.proxy_settings for it
+PROXY_SETTINGS_BUILDERS = {
+    "vmess": lambda s: {"id": s.get("id")},
+    "vless": lambda s: {"id": s.get("id"), "flow": s.get("flow", "")},
+    "trojan": lambda s: {"password": s.get("password")},
+    "shadowsocks": lambda s: {"password": s.get("password"), "method": s.get("method")},
+}
+
 # Global list for reporting failed/skipped items
 MIGRATION_SUMMARY_REPORT: List[str] = []
 
+# --- PRECOMPILED PATTERNS ---
+# Every regex the script uses is compiled once here at import; no re.* call takes a literal pattern.
+# mysql+<driver>://user:password@host:port/db (db stops before any ?query or #fragment)
+_SQLA_URL_RE = re.compile(r"mysql\+(?:asyncmy|pymysql)://([^:]+):([^@]+)@([^:/]+):(\d+)/([^?#]+)")
+
+# Leading major.minor.patch of a server version string such as "8.0.36" or "10.11.6-MariaDB"
+_SERVER_VERSION_RE = re.compile(r"(\d+)\.(\d+)\.(\d+)")
+
+# Port settings rewritten by change_db_port, one alternation per file so each is scanned once.
+# Bytes patterns: the files are ASCII config, so they are edited without a decode/encode round trip.
+# .env: db_port is the DB_PORT= prefix; url_head/url_tail surround the port of a local SQLALCHEMY_DATABASE_URL.
+_ENV_PORTS_RE = re.compile(
+    rb'(?P<db_port>DB_PORT=)\d+'
+    rb'|(?P<url_head>SQLALCHEMY_DATABASE_URL="mysql\+(?:asyncmy|pymysql)://[^:]+:[^@]+@127\.0\.0\.1:)\d+(?P<url_tail>/[^"]+")'
+)
+# docker-compose.yml: one named prefix group per setting; match.lastgroup says which one matched
+_COMPOSE_PORTS_RE = re.compile(rb'(?P<port>--port=)\d+|(?P<pma_port>PMA_PORT: )\d+|(?P<apache_port>APACHE_PORT: )\d+')
+# Anchors used to insert compose settings that are missing from the file
+_BIND_ADDR_RE = re.compile(rb'(command:\n\s+- --bind-address=127\.0\.0\.1)')
+_PMA_HOST_RE = re.compile(rb'(environment:\n\s+PMA_HOST: 127\.0\.0\.1)')
+_PMA_HOST_PORT_RE = re.compile(rb'(environment:\n\s+PMA_HOST: 127\.0\.0\.1\n\s+PMA_PORT: \d+)')
+
 # --- UI & SYSTEM FUNCTIONS ---
+def log(message: str, color: str = "", flush: bool = False):
+    """Write one progress line with a single write() call.
+
+    print() writes the text and the newline separately, so lines from parallel workers can interleave;
+    with stdout block-buffered during a migration, flush=True is kept for the phase start/end lines.
+    """
+    sys.stdout.write(f"{color}{message}{RESET}\n" if color else f"{message}\n")
+    if flush:
+        sys.stdout.flush()
+
+def prompt(text: str = "") -> str:
+    """input() for terminals; piped stdin is read as raw lines, and end of input exits cleanly."""
+    if sys.stdin.isatty():
+        try:
+            return input(text)
+        except EOFError:
+            print()
+            sys.exit(0)
+    sys.stdout.write(text)
+    sys.stdout.flush()
+    line = sys.stdin.buffer.readline()
+    if not line:
+        print()
+        sys.exit(0)
+    return line.decode("utf-8", "replace").rstrip("\r\n")
+
+# What `clear` prints: cursor home, erase the screen, erase the scrollback
+CLEAR_SCREEN = "\033[H\033[2J\033[3J"
+
+# The main menu never changes, so it is rendered once at import
+MENU_TEXT = (
+    f"{CYAN}╔═════════════════════════════════════════════╗\n"
+    f"║{YELLOW}          Power By: ASiSSK                     {CYAN}║\n"
+    f"║{YELLOW}          Marz ➔ Pasarguard                  {CYAN}║\n"
+    f"║{YELLOW}              v1.5.1                         {CYAN}║\n"
+    f"╚═════════════════════════════════════════════╝{RESET}\n"
+    "\n"
+    "Menu:\n"
+    "1. Change Database and phpMyAdmin Ports (Pasarguard)\n"
+    "2. Migrate Marzban to Pasarguard (Local Mode Only)\n"
+    "3. Exit\n"
+    "\n"
+)
+
 def clear_screen():
-    os.system("clear")
+    # Writing the escape sequence directly avoids forking a shell and `clear` on every screen
+    sys.stdout.write(CLEAR_SCREEN)
+    sys.stdout.flush()
 
 def display_menu():
-    clear_screen()
-    print(f"{CYAN}╔═════════════════════════════════════════════╗")
-    print(f"║{YELLOW}          Power By: ASiSSK                     {CYAN}║")
-    print(f"║{YELLOW}          Marz ➔ Pasarguard                  {CYAN}║")
-    print(f"║{YELLOW}              v1.5.1                         {CYAN}║")
-    print(f"╚═════════════════════════════════════════════╝{RESET}")
-    print()
-    print("Menu:")
-    print("1. Change Database and phpMyAdmin Ports (Pasarguard)")
-    print("2. Migrate Marzban to Pasarguard (Local Mode Only)")
-    print("3. Exit")
-    print()
+    # Clear and redraw in one write, so the menu appears without a blank frame in between
+    sys.stdout.write(CLEAR_SCREEN + MENU_TEXT)
+    sys.stdout.flush()
 
 def check_dependencies():
-    try:
-        import pymysql
-        import dotenv
-    except ImportError as e:
-        print(f"{RED}Critical Dependency Error: {str(e)}.{RESET}")
-        print(f"{RED}Please ensure all packages are installed (pymysql, python-dotenv).{RESET}")
+    global _DEPS_OK
+    # Installed packages do not change while the menu runs, so only the first call probes
+    if _DEPS_OK:
+        return
+    # find_spec only locates the packages; importing them is left to the code that uses them
+    missing = [name for name in ("pymysql",) if importlib.util.find_spec(name) is None]
+    if missing:
+        print(f"{RED}Critical Dependency Error: No module named {', '.join(missing)}.{RESET}")
+        print(f"{RED}Please ensure all packages are installed (pymysql).{RESET}")
         sys.exit(1)
+    _DEPS_OK = True
+
+def load_pymysql():
+    global pymysql
+    import pymysql.cursors
     
 # --- HELPER FUNCTIONS ---
 def safe_alpn(value: Optional[str]) -> Optional[str]:
-    if not value or str(value).strip().lower() in ["none", "null", ""]:
+    if not value:
         return None
-    return str(value).strip()
-
-def safe_json(value: Any) -> Optional[str]:
+    # Normalise once; the check and the returned value share the stripped string
+    value = str(value).strip()
+    if value.lower() in ("none", "null", ""):
+        return None
+    return value
+
+# Unix timestamps from here on cannot be stored in a DATETIME column (a day short of year 10000, so any
+# local UTC offset still converts), which also keeps fromtimestamp inside its supported range
+MAX_EXPIRE_TIMESTAMP = 253402214400
+
+# Compact separators trim the JSON written to MySQL; one shared encoder avoids rebuilding it per call
+if orjson is not None:
+    def compact_json(value: Any) -> str:
+        # orjson is always compact; NON_STR_KEYS accepts int keys the way json.dumps does
+        return orjson.dumps(value, option=orjson.OPT_NON_STR_KEYS).decode()
+    json_loads = orjson.loads
+else:
+    compact_json = json.JSONEncoder(separators=(",", ":")).encode
+    json_loads = json.loads
+
+# First characters a JSON document can start with
+JSON_START_CHARS = frozenset('{["-0123456789tfn')
+
+def safe_json(value: Any, validate: bool = True) -> Optional[str]:
+    """Return value as a JSON string for a JSON column, or None when it is not JSON.
+
+    validate=False skips the full parse for strings read from a native JSON column, which the server
+    has already validated.
+    """
     if value is None or value == "":
         return None
+    if not isinstance(value, str):
+        try:
+            return compact_json(value)
+        except (TypeError, ValueError):
+            return None
+    # Plain text can be rejected from its first character without parsing it
+    if value.lstrip()[:1] not in JSON_START_CHARS:
+        return None
+    if not validate:
+        return value
     try:
-        if isinstance(value, str):
-            json.loads(value)
-        return json.dumps(value) if not isinstance(value, str) else value
-    except:
+        json_loads(value)
+    except ValueError:
         return None
+    return value
+
+@functools.lru_cache(maxsize=8)
+def parse_env_file(env_path: str, mtime_ns: int, size: int) -> Dict[str, str]:
+    """Parse a .env file; cached per (path, mtime, size) so a rewritten file is parsed again."""
+    # The .env files are a handful of KEY=VALUE lines; a plain line scan is all they need
+    env = {}
+    with open(env_path, 'r', encoding='utf-8') as file:
+        for line in file:
+            line = line.strip()
+            if not line or line.startswith("#") or "=" not in line:
+                continue
+            key, value = line.split("=", 1)
+            key = key.strip()
+            if key.startswith("export "):
+                key = key[len("export "):].strip()
+            value = value.strip()
+            if value[:1] in ("'", '"'):
+                end = value.find(value[0], 1)
+                value = value[1:end] if end != -1 else value[1:]
+            else:
+                value = value.split(" #", 1)[0].rstrip()
+            env[key] = value
+    return env
 
 def load_env_file(env_path: str) -> Optional[Dict[str, str]]:
-    if not os.path.exists(env_path):
+    # One stat for the cache key doubles as the existence check; a missing read permission surfaces
+    # from the open inside parse_env_file instead of a separate access() probe
+    try:
+        st = os.stat(env_path)
+    except FileNotFoundError:
         return None
-    if not os.access(env_path, os.R_OK):
+    try:
+        # Copy so callers cannot modify the cached dict
+        return dict(parse_env_file(env_path, st.st_mtime_ns, st.st_size))
+    except PermissionError:
         print(f"{RED}Permission Error: No read permission for {env_path}.{RESET}")
         return None
-    try:
-        env = dotenv_values(env_path)
-        return env
     except Exception as e:
         print(f"{RED}Error loading {env_path}: {str(e)}{RESET}")
         return None
 
-def parse_sqlalchemy_url(url: str) -> Dict[str, Any]:
-    pattern = r"mysql\+(asyncmy|pymysql)://([^:]+):([^@]+)@([^:]+):(\d+)/(.+)"
-    match = re.match(pattern, url)
+@functools.lru_cache(maxsize=8)
+def _parse_sqlalchemy_url(url: str) -> Tuple[str, str, str, int, str]:
+    # Keyed on the URL itself, so a changed .env yields a new entry rather than a stale config
+    match = _SQLA_URL_RE.match(url)
     if not match:
         raise ValueError(f"Invalid SQLALCHEMY_DATABASE_URL: {url}")
-    return {
-        "user": match.group(2),
-        "password": match.group(3),
-        "host": match.group(4),
-        "port": int(match.group(5)),
-        "db": match.group(6)
-    }
+    user, password, host, port, db = match.groups()
+    return user, password, host, int(port), db
+
+def parse_sqlalchemy_url(url: str) -> Dict[str, Any]:
+    user, password, host, port, db = _parse_sqlalchemy_url(url)
+    # A fresh dict per call: callers add cursorclass and connect options to it
+    return {"user": user, "password": password, "host": host, "port": port, "db": db}
 
 def get_db_config(env_path: str, name: str, manual_input: bool = False) -> Optional[Dict[str, Any]]:
     global MIGRATION_SUMMARY_REPORT
     
     if manual_input:
         print(f"{CYAN}--- {name.upper()} DATABASE SETTINGS (Manual Input) ---{RESET}")
-        host = input(f"Enter {name} DB Host (e.g., 127.0.0.1): ").strip()
-        port_str = input(f"Enter {name} DB Port (e.g., 3306): ").strip()
-        user = input(f"Enter {name} DB User (e.g., marzban): ").strip()
-        password = input(f"Enter {name} DB Password: ").strip()
-        db_name = input(f"Enter {name} DB Name (e.g., marzban): ").strip()
+        host = prompt(f"Enter {name} DB Host (e.g., 127.0.0.1): ").strip()
+        port_str = prompt(f"Enter {name} DB Port (e.g., 3306): ").strip()
+        user = prompt(f"Enter {name} DB User (e.g., marzban): ").strip()
+        password = prompt(f"Enter {name} DB Password: ").strip()
+        db_name = prompt(f"Enter {name} DB Name (e.g., marzban): ").strip()
 
         if not all([host, port_str, user, password, db_name]):
             MIGRATION_SUMMARY_REPORT.append(f"{RED}Failure: {name} DB config missing required fields.{RESET}")
@@ -129,9 +417,9 @@ def get_db_config(env_path: str, name: str, manual_input: bool = False) -> Optio
             "host": host,
             "port": port,
             "db": db_name,
-            "charset": "utf8mb4",
-            "cursorclass": pymysql.cursors.DictCursor
+            "cursorclass": pymysql.cursors.DictCursor,
         }
+        config.update(BULK_CONNECT_OPTIONS)
         print(f"{CYAN}Using: host={config['host']}, port={config['port']}, user={config['user']}, db={config['db']}{RESET}")
         return config
 
@@ -149,8 +437,8 @@ def get_db_config(env_path: str, name: str, manual_input: bool = False) -> Optio
              return None
 
         config = parse_sqlalchemy_url(sqlalchemy_url)
-        config["charset"] = "utf8mb4"
         config["cursorclass"] = pymysql.cursors.DictCursor
+        config.update(BULK_CONNECT_OPTIONS)
         print(f"{CYAN}--- {name.upper()} DATABASE SETTINGS (From File) ---{RESET}")
         print(f"Using: host={config['host']}, port={config['port']}, user={config['user']}, db={config['db']}{RESET}")
         return config
@@ -168,63 +456,362 @@ def read_xray_config() -> Optional[Dict[str, Any]]:
         return None
     try:
         with open(XRAY_CONFIG_PATH, 'r', encoding='utf-8') as file:
-            return json.load(file)
+            return json_loads(file.read())
     except Exception as e:
         MIGRATION_SUMMARY_REPORT.append(f"{YELLOW}Warning: Error reading or parsing xray_config.json: {str(e)}. Skipping Xray config migration.{RESET}")
         return None
 
-def connect(cfg: Dict[str, Any]) -> Optional[pymysql.connections.Connection]:
+def pool_key(cfg: Dict[str, Any]) -> tuple:
+    return tuple(sorted(cfg.items()))
+
+def connect(cfg: Dict[str, Any]) -> Optional["pymysql.connections.Connection"]:
+    """Borrow an idle pooled connection for cfg (checked with a ping) or open a new one."""
     global MIGRATION_SUMMARY_REPORT
+    with CONNECTION_POOL_LOCK:
+        idle = CONNECTION_POOL[pool_key(cfg)]
+        conn = idle.pop() if idle else None
+    if conn is not None:
+        try:
+            # A dead connection is replaced below rather than through ping(reconnect=True), which is deprecated
+            conn.ping(reconnect=False)
+            log(f"Reusing connection to {cfg['db']}@{cfg['host']}:{cfg['port']} ✓", GREEN)
+            return conn
+        except Exception:
+            close_quietly(conn)
     try:
         conn = pymysql.connect(**cfg)
-        print(f"{GREEN}Connected to {cfg['db']}@{cfg['host']}:{cfg['port']} ✓{RESET}")
-        time.sleep(0.5)
+        log(f"Connected to {cfg['db']}@{cfg['host']}:{cfg['port']} ✓", GREEN)
         return conn
     except Exception as e:
         MIGRATION_SUMMARY_REPORT.append(f"{RED}Failure: Connection to DB {cfg['db']}@{cfg['host']}:{cfg['port']} failed: {str(e)}{RESET}")
         return None
 
+def release_connection(cfg: Dict[str, Any], conn):
+    """Hand conn back to the pool so the next migration from the menu skips the handshake."""
+    if conn is None:
+        return
+    # Autocommit is off, so even a read-only session holds a snapshot and metadata locks until its
+    # transaction ends; end it here so an idle pooled connection neither reads stale data next time
+    # nor blocks ALTERs on the source tables while the menu waits
+    try:
+        conn.rollback()
+    except Exception:
+        close_quietly(conn)
+        return
+    with CONNECTION_POOL_LOCK:
+        idle = CONNECTION_POOL[pool_key(cfg)]
+        if len(idle) < CONNECTION_POOL_MAX_IDLE:
+            idle.append(conn)
+            return
+    close_quietly(conn)
+
+def close_quietly(conn):
+    try:
+        conn.close()
+    except Exception:
+        pass
+
+@atexit.register
+def close_pooled_connections():
+    with CONNECTION_POOL_LOCK:
+        for idle in CONNECTION_POOL.values():
+            for conn in idle:
+                close_quietly(conn)
+        CONNECTION_POOL.clear()
+
+def load_existing_tables(conn) -> Set[str]:
+    """Return the lowercase table names of the connected schema in one round trip."""
+    with conn.cursor(pymysql.cursors.Cursor) as cur:
+        cur.execute("SELECT table_name AS t FROM information_schema.tables WHERE table_schema = DATABASE()")
+        return {r[0].lower() for r in cur.fetchall()}
+
+def build_select_sql(conn, table: str, columns: Tuple[str, ...]) -> str:
+    """SELECT only the wanted columns that exist in this schema.
+
+    Older Marzban releases lack some optional columns; those are left out here and read with row.get().
+    """
+    with conn.cursor(pymysql.cursors.Cursor) as cur:
+        cur.execute(
+            "SELECT column_name AS c FROM information_schema.columns WHERE table_schema = DATABASE() AND table_name = %s",
+            (table,),
+        )
+        present = {r[0].lower() for r in cur.fetchall()}
+    wanted = [c for c in columns if c in present]
+    return f"SELECT {', '.join(wanted) if wanted else '*'} FROM {table}"
+
+def supports_row_alias(conn) -> bool:
+    """True for MySQL 8.0.19+, where an upsert can name its new row instead of using the deprecated VALUES().
+
+    MariaDB only understands VALUES(). The server version comes from the connection handshake, so this
+    costs no round trip. Older pymysql releases do not recognise the alias form as a batchable INSERT,
+    so it is only used when executemany can still rewrite it into one multi-row statement.
+    """
+    version = conn.get_server_info()
+    match = _SERVER_VERSION_RE.match(version)
+    if not match or "mariadb" in version.lower():
+        return False
+    if tuple(int(n) for n in match.groups()) < (8, 0, 19):
+        return False
+    return bool(pymysql.cursors.RE_INSERT_VALUES.match(build_insert_sql("t", ("a", "b"), row_alias=True)))
+
+def build_insert_sql(table: str, columns: Tuple[str, ...], fresh: bool = False, row_alias: bool = False) -> str:
+    """INSERT for one row of columns; upserts on the primary key unless the target was emptied by --fresh.
+
+    Each value is bound once: the UPDATE part refers back to the inserted row, through the new row alias
+    when row_alias is set and VALUES() otherwise.
+    """
+    sql = f"INSERT INTO {table} ({', '.join(columns)}) VALUES ({','.join(['%s'] * len(columns))})"
+    if fresh:
+        return sql
+    if row_alias:
+        return sql + " AS new ON DUPLICATE KEY UPDATE " + ", ".join(f"{c} = new.{c}" for c in columns[1:])
+    return sql + " ON DUPLICATE KEY UPDATE " + ", ".join(f"{c} = VALUES({c})" for c in columns[1:])
+
+def build_merge_sql(table: str, columns: Tuple[str, ...], source: str, fresh: bool = False) -> str:
+    """INSERT ... SELECT of columns from source (a staging table or another schema's table) into table.
+
+    Upserts on the primary key unless the target was emptied by --fresh. The UPDATE part names the source
+    columns, which both MySQL and MariaDB accept and which avoids VALUES(), deprecated since MySQL 8.0.20.
+    """
+    sql = f"INSERT INTO {table} ({', '.join(columns)}) SELECT {', '.join(columns)} FROM {source} AS src"
+    if fresh:
+        return sql
+    return sql + " ON DUPLICATE KEY UPDATE " + ", ".join(f"{c} = src.{c}" for c in columns[1:])
+
+def iter_batches(rows: Iterable[tuple], size: int = BATCH_SIZE) -> Iterable[List[tuple]]:
+    """Yield lists of up to size rows; islice does the slicing in C instead of a per-row append loop."""
+    it = iter(rows)
+    batch = list(islice(it, size))
+    while batch:
+        yield batch
+        batch = list(islice(it, size))
+
+def stmt_length_limit(cur) -> int:
+    """Longest multi-row INSERT to build: MAX_STMT_LENGTH, or less when the server accepts smaller packets."""
+    cur.execute("SELECT @@max_allowed_packet")
+    # Leave room for the packet header and the command byte
+    return min(MAX_STMT_LENGTH, int(cur.fetchone()[0]) - 1024)
+
+def insert_batched(cur, sql: str, rows: Iterable[tuple]) -> int:
+    """Send rows through executemany in BATCH_SIZE chunks; pymysql rewrites each chunk into one multi-row INSERT.
+
+    rows may be a generator over a streaming cursor, so only one batch is held in memory at a time.
+    """
+    cur.max_stmt_length = stmt_length_limit(cur)
+    count = 0
+    for batch in iter_batches(rows):
+        cur.executemany(sql, batch)
+        count += len(batch)
+    return count
+
 # --- MIGRATION FUNCTIONS ---
 
-def migrate_admins(marzban_conn, pasarguard_conn) -> int:
-    global MIGRATION_SUMMARY_REPORT
-    count = 0
+# Backslash escapes LOAD DATA understands with its default ESCAPED BY '\\'
+TSV_ESCAPES = str.maketrans({"\\": "\\\\", "\t": "\\t", "\n": "\\n", "\r": "\\r", "\0": "\\0"})
+
+def tsv_field(value: Any) -> str:
+    if value is None:
+        return "\\N"
+    if isinstance(value, bool):
+        return "1" if value else "0"
+    if isinstance(value, bytes):
+        value = value.decode("utf-8")
+    return str(value).translate(TSV_ESCAPES)
+
+def supports_local_infile(conn) -> bool:
+    """True when the server accepts LOAD DATA LOCAL INFILE (MySQL 8 ships with it off)."""
     try:
-        with marzban_conn.cursor() as cur:
-            cur.execute("SELECT * FROM admins")
-            admins = cur.fetchall()
+        with conn.cursor(pymysql.cursors.Cursor) as cur:
+            cur.execute("SELECT @@local_infile AS v")
+            return bool(int(cur.fetchone()[0]))
+    except Exception:
+        return False
 
-        with pasarguard_conn.cursor() as cur:
-            cur.execute("SHOW TABLES LIKE 'admins'")
-            if cur.fetchone() is None:
-                cur.execute("""
-                    CREATE TABLE admins (
-                        id INT PRIMARY KEY, username VARCHAR(255) NOT NULL, hashed_password TEXT NOT NULL,
-                        created_at DATETIME NOT NULL, is_sudo BOOLEAN DEFAULT FALSE,
-                        password_reset_at DATETIME, telegram_id BIGINT, discord_webhook TEXT
-                    )
-                """)
-                print(f"{GREEN}Created admins table in Pasarguard ✓{RESET}")
-                time.sleep(0.5)
+def load_data_local(cur, table: str, columns: Tuple[str, ...], rows: Iterable[tuple], fresh: bool = True) -> int:
+    """Stream rows to a temporary TSV file and ingest it with one LOAD DATA LOCAL INFILE (--load-data only).
+
+    With --fresh the target table was just emptied, so the file goes straight in. Otherwise it is loaded into
+    a session-private staging copy of the table and merged with one INSERT ... SELECT that keeps the upsert
+    semantics of build_insert_sql(). LOCAL implies IGNORE, so the server coerces or skips bad rows instead of
+    failing; a load that raised warnings therefore fails the table, which rolls back to its savepoint.
+    Returns the number of rows the server stored.
+    """
+    target = table if fresh else f"{table}_stage"
+    with tempfile.NamedTemporaryFile("w", encoding="utf-8", newline="\n", suffix=".tsv") as tmp:
+        write = tmp.write
+        for row in rows:
+            write("\t".join(map(tsv_field, row)) + "\n")
+        tmp.flush()
+        if not fresh:
+            # Temporary tables do not commit implicitly, so staging stays inside the data transaction
+            cur.execute(f"CREATE TEMPORARY TABLE {target} LIKE {table}")
+        try:
+            cur.execute(
+                f"LOAD DATA LOCAL INFILE %s INTO TABLE {target} CHARACTER SET utf8mb4 "
+                f"FIELDS TERMINATED BY '\\t' LINES TERMINATED BY '\\n' ({', '.join(columns)})",
+                (tmp.name,),
+            )
+            # Rows stored, not lines written: skipped duplicates are not counted. The staging table started
+            # empty and the merge writes every staged row, so this is also the merged count.
+            count = cur.rowcount
+            # Truncated strings, coerced enums and skipped duplicates only show up as warnings
+            cur.execute("SELECT @@warning_count")
+            warning_count = cur.fetchone()[0]
+            if warning_count:
+                cur.execute("SHOW WARNINGS LIMIT 3")
+                samples = "; ".join(str(w[2]) for w in cur.fetchall())
+                raise ValueError(f"LOAD DATA raised {warning_count} warning(s), e.g. {samples}; the table was not loaded")
+            if not fresh:
+                cur.execute(build_merge_sql(table, columns, target))
+        finally:
+            if not fresh:
+                cur.execute(f"DROP TEMPORARY TABLE IF EXISTS {target}")
+    return count
 
-            for a in admins:
-                cur.execute(
-                    """
-                    INSERT INTO admins (id, username, hashed_password, created_at, is_sudo, password_reset_at, telegram_id, discord_webhook)
-                    VALUES (%s,%s,%s,%s,%s,%s,%s,%s)
-                    ON DUPLICATE KEY UPDATE
-                        username = %s, hashed_password = %s, created_at = %s, is_sudo = %s,
-                        password_reset_at = %s, telegram_id = %s, discord_webhook = %s
-                    """,
-                    (
-                        a["id"], a["username"], a["hashed_password"], a["created_at"], a["is_sudo"],
-                        a["password_reset_at"], a["telegram_id"], a["discord_webhook"],
-                        a["username"], a["hashed_password"], a["created_at"], a["is_sudo"],
-                        a["password_reset_at"], a["telegram_id"], a["discord_webhook"]
-                    ),
+def bulk_insert(cur, table: str, columns: Tuple[str, ...], rows: Iterable[tuple],
+                fresh: bool = False, load_data: bool = False) -> int:
+    """Copy rows into table: one LOAD DATA LOCAL INFILE when the server allows it, multi-row INSERTs otherwise."""
+    if load_data:
+        return load_data_local(cur, table, columns, rows, fresh)
+    return insert_batched(cur, build_insert_sql(table, columns, fresh, supports_row_alias(cur.connection)), rows)
+
+def ensure_pasarguard_tables(pasarguard_conn, existing_tables: Set[str]):
+    """Create missing tables up front: DDL commits implicitly, so it must not run inside the data transaction."""
+    global MIGRATION_SUMMARY_REPORT
+    with pasarguard_conn.cursor() as cur:
+        for table, ddl in PASARGUARD_TABLES:
+            if table in existing_tables:
+                continue
+            try:
+                cur.execute(ddl)
+                existing_tables.add(table)
+                log(f"Created `{table}` table in Pasarguard ✓", GREEN)
+            except Exception as e:
+                MIGRATION_SUMMARY_REPORT.append(f"{YELLOW}Warning: Failed to create `{table}` table: {str(e)}. Migration of this table may fail.{RESET}")
+
+def set_bulk_checks(conn, enabled: bool):
+    """Toggle per-row FOREIGN KEY and UNIQUE validation for this session only."""
+    flag = 1 if enabled else 0
+    with conn.cursor() as cur:
+        cur.execute(f"SET FOREIGN_KEY_CHECKS = {flag}, UNIQUE_CHECKS = {flag}")
+
+def truncate_migrated_tables(pasarguard_conn, existing_tables: Set[str]):
+    """Empty the tables the migration fills so --fresh can use plain INSERTs. TRUNCATE is DDL and commits implicitly."""
+    global MIGRATION_SUMMARY_REPORT
+    with pasarguard_conn.cursor() as cur:
+        # With FK checks off TRUNCATE does not cascade, so rows in other tables that point at the cleared
+        # ones (e.g. users_groups_association) are kept and left orphaned
+        cleared = [t for t in FRESH_TRUNCATE_ORDER if t in existing_tables]
+        if cleared:
+            cur.execute(
+                "SELECT DISTINCT table_name FROM information_schema.key_column_usage "
+                f"WHERE table_schema = DATABASE() AND referenced_table_name IN ({', '.join(['%s'] * len(cleared))})",
+                cleared,
+            )
+            orphaned = sorted({r[0] for r in cur.fetchall()} - set(FRESH_TRUNCATE_ORDER))
+            if orphaned:
+                MIGRATION_SUMMARY_REPORT.append(
+                    f"{YELLOW}Warning: --fresh kept the rows of {', '.join(orphaned)}, which reference the cleared tables; "
+                    f"review them for orphaned entries.{RESET}"
                 )
-                count += 1
-        pasarguard_conn.commit()
+        cur.execute("SET FOREIGN_KEY_CHECKS = 0")
+        try:
+            for table in FRESH_TRUNCATE_ORDER:
+                if table in existing_tables:
+                    cur.execute(f"TRUNCATE TABLE {table}")
+                    log(f"Cleared `{table}` table in Pasarguard ✓", GREEN)
+        finally:
+            cur.execute("SET FOREIGN_KEY_CHECKS = 1")
+
+def drop_secondary_indexes(pasarguard_conn, existing_tables: Set[str]) -> Dict[str, List[str]]:
+    """Drop the non-unique secondary indexes of the emptied tables so the load does not maintain them per row.
+
+    Returns the ADD INDEX clauses needed to rebuild them, per table. DDL commits implicitly, so this runs
+    before the data transaction. Indexes a foreign key relies on cannot be dropped and are kept, as are
+    functional indexes, which cannot be rebuilt from their column list.
+    """
+    tables = [t for t in FRESH_DEFERRED_INDEX_TABLES if t in existing_tables]
+    dropped = defaultdict(list)
+    if not tables:
+        return dropped
+    with pasarguard_conn.cursor() as cur:
+        cur.execute(
+            "SELECT table_name, index_name, column_name, sub_part, collation FROM information_schema.statistics "
+            f"WHERE table_schema = DATABASE() AND table_name IN ({','.join(['%s'] * len(tables))}) "
+            "AND non_unique = 1 AND index_type = 'BTREE' ORDER BY table_name, index_name, seq_in_index",
+            tables,
+        )
+        indexes = defaultdict(list)
+        for table, index, column, sub_part, collation in cur.fetchall():
+            part = None
+            if column is not None:
+                part = f"`{column}`" + (f"({sub_part})" if sub_part else "") + (" DESC" if collation == "D" else "")
+            indexes[(table.lower(), index)].append(part)
+        for (table, index), parts in indexes.items():
+            if None in parts:
+                continue
+            try:
+                cur.execute(f"ALTER TABLE {table} DROP INDEX `{index}`")
+            except Exception:
+                continue
+            dropped[table].append(f"ADD INDEX `{index}` ({', '.join(parts)})")
+    return dropped
+
+def restore_secondary_indexes(pasarguard_conn, dropped: Dict[str, List[str]]):
+    """Rebuild the indexes drop_secondary_indexes removed; one ALTER per table builds them in a single pass."""
+    global MIGRATION_SUMMARY_REPORT
+    with pasarguard_conn.cursor() as cur:
+        for table, clauses in dropped.items():
+            sql = f"ALTER TABLE {table} {', '.join(clauses)}"
+            try:
+                cur.execute(sql)
+                log(f"Rebuilt {len(clauses)} index(es) on `{table}` ✓", GREEN)
+            except Exception as e:
+                MIGRATION_SUMMARY_REPORT.append(f"{RED}Failure: Could not rebuild indexes on `{table}`: {str(e)}. Run manually: {sql}{RESET}")
+
+@contextlib.contextmanager
+def table_savepoint(pasarguard_conn, name: str):
+    """Scope one table's writes inside the migration transaction.
+
+    A table that fails part way is rolled back to where it started, so it is skipped cleanly instead of
+    leaving some of its batches behind; the single COMMIT at the end still covers every table.
+    """
+    with pasarguard_conn.cursor() as cur:
+        cur.execute(f"SAVEPOINT {name}")
+    try:
+        yield
+    except Exception:
+        with pasarguard_conn.cursor() as cur:
+            cur.execute(f"ROLLBACK TO SAVEPOINT {name}")
+        raise
+    with pasarguard_conn.cursor() as cur:
+        cur.execute(f"RELEASE SAVEPOINT {name}")
+
+def copy_on_server(cur, source_db: str, table: str, columns: Tuple[str, ...], fresh: bool = False) -> int:
+    """Copy table from another schema on the same server with one INSERT ... SELECT; no row crosses the client."""
+    cur.execute(build_merge_sql(table, columns, f"`{source_db}`.{table}", fresh))
+    # The affected-rows count doubles for updated rows, so count the source instead
+    cur.execute(f"SELECT COUNT(*) FROM `{source_db}`.{table}")
+    return cur.fetchone()[0]
+
+def migrate_admins(marzban_conn, pasarguard_conn, fresh: bool = False, load_data: bool = False,
+                   source_db: Optional[str] = None) -> int:
+    global MIGRATION_SUMMARY_REPORT
+    count = 0
+    try:
+        with table_savepoint(pasarguard_conn, "admins"), pasarguard_conn.cursor() as cur:
+            if source_db:
+                # Admins are copied verbatim, so when Marzban lives on the same server the copy can stay there.
+                # A failed INSERT ... SELECT changes nothing, e.g. when this user may not read the Marzban schema.
+                try:
+                    return copy_on_server(cur, source_db, "admins", ADMIN_COLUMNS, fresh)
+                except Exception as e:
+                    log(f"Server-side copy of admins unavailable ({str(e)}); copying through the client.", YELLOW)
+            # Admin rows are copied verbatim, so a tuple cursor selecting the INSERT's column order
+            # passes them through without building a dict per row
+            with marzban_conn.cursor(pymysql.cursors.SSCursor) as src:
+                src.execute(f"SELECT {', '.join(ADMIN_COLUMNS)} FROM admins")
+                count = bulk_insert(cur, "admins", ADMIN_COLUMNS, src, fresh, load_data)
     except Exception as e:
         MIGRATION_SUMMARY_REPORT.append(f"{YELLOW}Warning: Failed to migrate admins: {str(e)}. Skipping this table.{RESET}")
     return count
@@ -233,22 +820,14 @@ def ensure_default_group(pasarguard_conn):
     global MIGRATION_SUMMARY_REPORT
     try:
         with pasarguard_conn.cursor() as cur:
-            cur.execute("SHOW TABLES LIKE 'groups'")
-            if cur.fetchone() is None:
-                cur.execute("""
-                    CREATE TABLE `groups` (
-                        id INT PRIMARY KEY, name VARCHAR(255) NOT NULL, is_disabled BOOLEAN DEFAULT FALSE
-                    )
-                """)
-                print(f"{GREEN}Created `groups` table in Pasarguard ✓{RESET}")
-                time.sleep(0.5)
-            
-            cur.execute("SELECT COUNT(*) AS cnt FROM `groups` WHERE id = 1")
-            if cur.fetchone()["cnt"] == 0:
-                cur.execute("INSERT INTO `groups` (id, name, is_disabled) VALUES (1, 'DefaultGroup', 0)")
-                print(f"{GREEN}Created default group in Pasarguard ✓{RESET}")
-                time.sleep(0.5)
-        pasarguard_conn.commit()
+            # Insert-if-missing in one statement; the no-op update leaves an existing group untouched
+            # and reports 0 affected rows, so no COUNT probe is needed first
+            cur.execute(
+                "INSERT INTO `groups` (id, name, is_disabled) VALUES (1, 'DefaultGroup', 0) "
+                "ON DUPLICATE KEY UPDATE id = id"
+            )
+            if cur.rowcount == 1:
+                log("Created default group in Pasarguard ✓", GREEN)
     except Exception as e:
         MIGRATION_SUMMARY_REPORT.append(f"{YELLOW}Warning: Failed to ensure default group: {str(e)}. This may cause issues.{RESET}")
 
@@ -256,34 +835,21 @@ def ensure_default_core_config(pasarguard_conn):
     global MIGRATION_SUMMARY_REPORT
     try:
         with pasarguard_conn.cursor() as cur:
-            cur.execute("SHOW TABLES LIKE 'core_configs'")
-            if cur.fetchone() is None:
-                cur.execute("""
-                    CREATE TABLE `core_configs` (
-                        id INT PRIMARY KEY, created_at DATETIME NOT NULL, name VARCHAR(255) NOT NULL,
-                        config JSON NOT NULL, exclude_inbound_tags TEXT, fallbacks_inbound_tags TEXT
-                    )
-                """)
-                print(f"{GREEN}Created `core_configs` table in Pasarguard ✓{RESET}")
-                time.sleep(0.5)
-            
-            cur.execute("SELECT COUNT(*) AS cnt FROM `core_configs` WHERE id = 1")
-            if cur.fetchone()["cnt"] == 0:
-                cfg = {
-                    "log": {"loglevel": "warning"}, "inbounds": [{"tag": "Shadowsocks TCP", "listen": "0.0.0.0", "port": 1080, "protocol": "shadowsocks", "settings": {"clients": [], "network": "tcp,udp"}}],
-                    "outbounds": [{"protocol": "freedom", "tag": "DIRECT"}, {"protocol": "blackhole", "tag": "BLOCK"}],
-                    "routing": {"rules": [{"ip": ["geoip:private"], "outboundTag": "BLOCK", "type": "field"}]}
-                }
-                cur.execute(
-                    """
-                    INSERT INTO `core_configs` (id, created_at, name, config, exclude_inbound_tags, fallbacks_inbound_tags)
-                    VALUES (1, NOW(), 'ASiS SK', %s, '', '')
-                    """,
-                    json.dumps(cfg),
-                )
-                print(f"{GREEN}Created default core config 'ASiS SK' in Pasarguard ✓{RESET}")
-                time.sleep(0.5)
-        pasarguard_conn.commit()
+            cfg = {
+                "log": {"loglevel": "warning"}, "inbounds": [{"tag": "Shadowsocks TCP", "listen": "0.0.0.0", "port": 1080, "protocol": "shadowsocks", "settings": {"clients": [], "network": "tcp,udp"}}],
+                "outbounds": [{"protocol": "freedom", "tag": "DIRECT"}, {"protocol": "blackhole", "tag": "BLOCK"}],
+                "routing": {"rules": [{"ip": ["geoip:private"], "outboundTag": "BLOCK", "type": "field"}]}
+            }
+            cur.execute(
+                """
+                INSERT INTO `core_configs` (id, created_at, name, config, exclude_inbound_tags, fallbacks_inbound_tags)
+                VALUES (1, NOW(), 'ASiS SK', %s, '', '')
+                ON DUPLICATE KEY UPDATE id = id
+                """,
+                compact_json(cfg),
+            )
+            if cur.rowcount == 1:
+                log("Created default core config 'ASiS SK' in Pasarguard ✓", GREEN)
     except Exception as e:
         MIGRATION_SUMMARY_REPORT.append(f"{YELLOW}Warning: Failed to ensure default core config: {str(e)}. This may cause issues.{RESET}")
 
@@ -292,14 +858,17 @@ def migrate_xray_config(pasarguard_conn, xray_config) -> int:
     if not xray_config: return 0
 
     try:
-        with pasarguard_conn.cursor() as cur:
-            cur.execute("SELECT * FROM `core_configs` WHERE id = 1")
+        with table_savepoint(pasarguard_conn, "core_configs"), pasarguard_conn.cursor() as cur:
+            # One round trip for both the current config and the next free id; no row means nothing to back up
+            cur.execute(
+                "SELECT (SELECT MAX(id) FROM `core_configs`) AS max_id, config, exclude_inbound_tags, fallbacks_inbound_tags "
+                "FROM `core_configs` WHERE id = 1"
+            )
             existing = cur.fetchone()
             backup_id = 0
             if existing:
-                cur.execute("SELECT MAX(id) AS max_id FROM `core_configs`")
-                max_id = cur.fetchone()["max_id"] or 1
-                backup_id = max_id + 1
+                max_id, config, exclude_inbound_tags, fallbacks_inbound_tags = existing
+                backup_id = (max_id or 1) + 1
                 
                 cur.execute(
                     """
@@ -309,371 +878,470 @@ def migrate_xray_config(pasarguard_conn, xray_config) -> int:
                     (
                         backup_id,
                         f"Backup_ASiS_SK_{datetime.datetime.now().strftime('%Y%m%d%H%M%S')}",
-                        existing["config"], existing["exclude_inbound_tags"], existing["fallbacks_inbound_tags"],
+                        config, exclude_inbound_tags, fallbacks_inbound_tags,
                     ),
                 )
-                print(f"{GREEN}Backup created as ID {backup_id} ✓{RESET}")
-                time.sleep(0.5)
+                log(f"Backup created as ID {backup_id} ✓", GREEN)
 
+            # Serialised once; the UPDATE part reuses the inserted row instead of a second copy
             cur.execute(
                 """
                 INSERT INTO `core_configs` (id, created_at, name, config, exclude_inbound_tags, fallbacks_inbound_tags)
                 VALUES (%s, NOW(), %s, %s, '', '')
                 ON DUPLICATE KEY UPDATE
-                    name = %s, config = %s, created_at = NOW()
+                    name = VALUES(name), config = VALUES(config), created_at = NOW()
                 """,
-                (1, "ASiS SK", json.dumps(xray_config), "ASiS SK", json.dumps(xray_config)),
+                (1, "ASiS SK", compact_json(xray_config)),
             )
-        pasarguard_conn.commit()
         return 1
     except Exception as e:
         MIGRATION_SUMMARY_REPORT.append(f"{YELLOW}Warning: Failed to migrate Xray config to core_configs: {str(e)}. Skipping this step.{RESET}")
         return 0
 
-def migrate_inbounds_and_associate(marzban_conn, pasarguard_conn) -> int:
+def migrate_inbounds_and_associate(marzban_conn, pasarguard_conn, fresh: bool = False, load_data: bool = False) -> int:
     global MIGRATION_SUMMARY_REPORT
     count = 0
     try:
-        with marzban_conn.cursor() as cur:
-            cur.execute("SELECT * FROM inbounds")
-            inbounds = cur.fetchall()
-
-        with pasarguard_conn.cursor() as cur:
-            cur.execute("SHOW TABLES LIKE 'inbounds'")
-            if cur.fetchone() is None:
-                cur.execute("CREATE TABLE inbounds (id INT PRIMARY KEY, tag VARCHAR(255) NOT NULL)")
-                print(f"{GREEN}Created inbounds table in Pasarguard ✓{RESET}")
-                time.sleep(0.5)
-
-            cur.execute("SHOW TABLES LIKE 'inbounds_groups_association'")
-            if cur.fetchone() is None:
-                cur.execute("""
-                    CREATE TABLE inbounds_groups_association (
-                        inbound_id INT, group_id INT, PRIMARY KEY (inbound_id, group_id),
-                        FOREIGN KEY (inbound_id) REFERENCES inbounds(id),
-                        FOREIGN KEY (group_id) REFERENCES `groups`(id)
-                    )
-                """)
-                print(f"{GREEN}Created inbounds_groups_association table in Pasarguard ✓{RESET}")
-                time.sleep(0.5)
-
-            for i in inbounds:
-                cur.execute("INSERT INTO inbounds (id, tag) VALUES (%s,%s) ON DUPLICATE KEY UPDATE tag = %s", (i["id"], i["tag"], i["tag"]))
-                cur.execute("INSERT IGNORE INTO inbounds_groups_association (inbound_id, group_id) VALUES (%s,1)", (i["id"],))
-                count += 1
-        pasarguard_conn.commit()
+        with table_savepoint(pasarguard_conn, "inbounds"), pasarguard_conn.cursor() as cur:
+            with marzban_conn.cursor() as src:
+                src.execute("SELECT id, tag FROM inbounds")
+                inbound_rows = [(i["id"], i["tag"]) for i in src]
+
+            count = bulk_insert(cur, "inbounds", ("id", "tag"), inbound_rows, fresh, load_data)
+            # Every inbound joins the default group. The group id is a literal in the VALUES list, which
+            # executemany cannot rewrite, so the multi-row statement is built here and only ids are sent.
+            for batch in iter_batches(inbound_id for inbound_id, _ in inbound_rows):
+                cur.execute(
+                    "INSERT IGNORE INTO inbounds_groups_association (inbound_id, group_id) VALUES "
+                    + ",".join(["(%s,1)"] * len(batch)),
+                    batch,
+                )
     except Exception as e:
         MIGRATION_SUMMARY_REPORT.append(f"{YELLOW}Warning: Failed to migrate inbounds: {str(e)}. Skipping this table.{RESET}")
     return count
 
-def migrate_hosts(marzban_conn, pasarguard_conn, safe_alpn_func) -> int:
+def migrate_hosts(marzban_conn, pasarguard_conn, safe_alpn_func, fresh: bool = False, load_data: bool = False) -> int:
     global MIGRATION_SUMMARY_REPORT
     count = 0
     try:
-        with marzban_conn.cursor() as cur:
-            cur.execute("SELECT * FROM hosts")
-            hosts = cur.fetchall()
-
-        with pasarguard_conn.cursor() as cur:
-            cur.execute("SHOW TABLES LIKE 'hosts'")
-            if cur.fetchone() is None:
-                cur.execute("""
-                    CREATE TABLE hosts (
-                        id INT PRIMARY KEY, remark VARCHAR(255), address VARCHAR(255), port INT,
-                        inbound_tag VARCHAR(255), sni TEXT, host TEXT, security VARCHAR(50), alpn TEXT,
-                        fingerprint TEXT, allowinsecure BOOLEAN, is_disabled BOOLEAN, path TEXT,
-                        random_user_agent BOOLEAN, use_sni_as_host BOOLEAN, priority INT DEFAULT 0,
-                        http_headers TEXT, transport_settings TEXT, mux_settings TEXT,
-                        noise_settings TEXT, fragment_settings TEXT, status VARCHAR(50)
-                    )
-                """)
-                print(f"{GREEN}Created hosts table in Pasarguard ✓{RESET}")
-                time.sleep(0.5)
-
-            for h in hosts:
-                cur.execute(
-                    """
-                    INSERT INTO hosts
-                    (id, remark, address, port, inbound_tag, sni, host, security, alpn,
-                     fingerprint, allowinsecure, is_disabled, path, random_user_agent,
-                     use_sni_as_host, priority, http_headers, transport_settings,
-                     mux_settings, noise_settings, fragment_settings, status)
-                    VALUES (%s,%s,%s,%s,%s,%s,%s,%s,%s,%s,%s,%s,%s,%s,%s,%s,%s,%s,%s,%s,%s,%s)
-                    ON DUPLICATE KEY UPDATE
-                        remark = %s, address = %s, port = %s, inbound_tag = %s, sni = %s, host = %s,
-                        security = %s, alpn = %s, fingerprint = %s, allowinsecure = %s, is_disabled = %s,
-                        path = %s, random_user_agent = %s, use_sni_as_host = %s, priority = %s,
-                        http_headers = %s, transport_settings = %s, mux_settings = %s,
-                        noise_settings = %s, fragment_settings = %s, status = %s
-                    """,
+        with table_savepoint(pasarguard_conn, "hosts"), pasarguard_conn.cursor() as cur:
+            select_sql = build_select_sql(marzban_conn, "hosts", HOST_COLUMNS)
+            with marzban_conn.cursor() as src:
+                src.execute(select_sql)
+                # MySQL JSON columns arrive already validated; text columns (and MariaDB, whose JSON is
+                # LONGTEXT) still need the parse
+                native_json = {d[0] for d in src.description if d[1] == pymysql.constants.FIELD_TYPE.JSON}
+                check = {c: c not in native_json for c in HOST_COLUMNS}
+                rows = (
                     (
                         h["id"], h["remark"], h["address"], h["port"], h["inbound_tag"],
                         h["sni"], h["host"], h["security"], safe_alpn_func(h.get("alpn")),
                         h["fingerprint"], h["allowinsecure"], h["is_disabled"], h.get("path"),
                         h.get("random_user_agent", 0), h.get("use_sni_as_host", 0), h.get("priority", 0),
-                        safe_json(h.get("http_headers")), safe_json(h.get("transport_settings")),
-                        safe_json(h.get("mux_settings")), safe_json(h.get("noise_settings")),
-                        safe_json(h.get("fragment_settings")), h.get("status"),
-                        h["remark"], h["address"], h["port"], h["inbound_tag"],
-                        h["sni"], h["host"], h["security"], safe_alpn_func(h.get("alpn")),
-                        h["fingerprint"], h["allowinsecure"], h["is_disabled"], h.get("path"),
-                        h.get("random_user_agent", 0), h.get("use_sni_as_host", 0), h.get("priority", 0),
-                        safe_json(h.get("http_headers")), safe_json(h.get("transport_settings")),
-                        safe_json(h.get("mux_settings")), safe_json(h.get("noise_settings")),
-                        safe_json(h.get("fragment_settings")), h.get("status")
-                    ),
+                        safe_json(h.get("http_headers"), check["http_headers"]),
+                        safe_json(h.get("transport_settings"), check["transport_settings"]),
+                        safe_json(h.get("mux_settings"), check["mux_settings"]),
+                        safe_json(h.get("noise_settings"), check["noise_settings"]),
+                        safe_json(h.get("fragment_settings"), check["fragment_settings"]), h.get("status")
+                    )
+                    for h in src
                 )
-                count += 1
-        pasarguard_conn.commit()
+                count = bulk_insert(cur, "hosts", HOST_COLUMNS, rows, fresh, load_data)
     except Exception as e:
         MIGRATION_SUMMARY_REPORT.append(f"{YELLOW}Warning: Failed to migrate hosts: {str(e)}. Skipping this table.{RESET}")
     return count
 
-def migrate_nodes(marzban_conn, pasarguard_conn) -> int:
+def migrate_nodes(marzban_conn, pasarguard_conn, fresh: bool = False, load_data: bool = False) -> int:
     global MIGRATION_SUMMARY_REPORT
     count = 0
     try:
-        with marzban_conn.cursor() as cur:
-            cur.execute("SELECT * FROM nodes")
-            nodes = cur.fetchall()
-
-        with pasarguard_conn.cursor() as cur:
-            cur.execute("SHOW TABLES LIKE 'nodes'")
-            if cur.fetchone() is None:
-                cur.execute("""
-                    CREATE TABLE nodes (
-                        id INT PRIMARY KEY, name VARCHAR(255) NOT NULL, address VARCHAR(255) NOT NULL,
-                        port INT, status VARCHAR(50), last_status_change DATETIME, message TEXT,
-                        created_at DATETIME NOT NULL, uplink BIGINT, downlink BIGINT,
-                        xray_version VARCHAR(50), usage_coefficient FLOAT, node_version VARCHAR(50),
-                        connection_type VARCHAR(50), server_ca TEXT, keep_alive BOOLEAN,
-                        max_logs INT, core_config_id INT, gather_logs BOOLEAN,
-                        FOREIGN KEY (core_config_id) REFERENCES `core_configs`(id)
-                    )
-                """)
-                print(f"{GREEN}Created nodes table in Pasarguard ✓{RESET}")
-                time.sleep(0.5)
-
-            for n in nodes:
-                cur.execute(
-                    """
-                    INSERT INTO nodes
-                    (id, name, address, port, status, last_status_change, message,
-                     created_at, uplink, downlink, xray_version, usage_coefficient,
-                     node_version, connection_type, server_ca, keep_alive, max_logs,
-                     core_config_id, gather_logs)
-                    VALUES (%s,%s,%s,%s,%s,%s,%s,%s,%s,%s,%s,%s,%s,%s,%s,%s,%s,1,1)
-                    ON DUPLICATE KEY UPDATE
-                        name = %s, address = %s, port = %s, status = %s, last_status_change = %s,
-                        message = %s, created_at = %s, uplink = %s, downlink = %s,
-                        xray_version = %s, usage_coefficient = %s, node_version = %s,
-                        connection_type = %s, server_ca = %s, keep_alive = %s, max_logs = %s,
-                        core_config_id = 1, gather_logs = 1
-                    """,
+        with table_savepoint(pasarguard_conn, "nodes"), pasarguard_conn.cursor() as cur:
+            # core_config_id and gather_logs have no Marzban counterpart
+            select_sql = build_select_sql(marzban_conn, "nodes", NODE_COLUMNS[:-2])
+            with marzban_conn.cursor() as src:
+                src.execute(select_sql)
+                rows = (
                     (
                         n["id"], n["name"], n["address"], n["port"], n["status"],
                         n["last_status_change"], n["message"], n["created_at"],
                         n["uplink"], n["downlink"], n["xray_version"], n["usage_coefficient"],
                         n["node_version"], n["connection_type"], n.get("server_ca", ""),
-                        n.get("keep_alive", 0), n.get("max_logs", 1000),
-                        n["name"], n["address"], n["port"], n["status"],
-                        n["last_status_change"], n["message"], n["created_at"],
-                        n["uplink"], n["downlink"], n["xray_version"], n["usage_coefficient"],
-                        n["node_version"], n["connection_type"], n.get("server_ca", ""),
-                        n.get("keep_alive", 0), n.get("max_logs", 1000)
-                    ),
+                        n.get("keep_alive", 0), n.get("max_logs", 1000), 1, 1
+                    )
+                    for n in src
                 )
-                count += 1
-        pasarguard_conn.commit()
+                count = bulk_insert(cur, "nodes", NODE_COLUMNS, rows, fresh, load_data)
     except Exception as e:
         MIGRATION_SUMMARY_REPORT.append(f"{YELLOW}Warning: Failed to migrate nodes: {str(e)}. Skipping this table.{RESET}")
     return count
 
-def migrate_users_and_proxies(marzban_conn, pasarguard_conn) -> int:
+def migrate_users_and_proxies(marzban_conn, pasarguard_conn, fresh: bool = False, load_data: bool = False) -> int:
     global MIGRATION_SUMMARY_REPORT
     total_users = 0
     
     try:
-        with marzban_conn.cursor() as cur:
-            cur.execute("SELECT * FROM users")
-            users = cur.fetchall()
+        # One scan of proxies grouped in memory instead of a SELECT per user
+        proxies_by_user = defaultdict(list)
+        with marzban_conn.cursor(pymysql.cursors.SSCursor) as src:
+            src.execute("SELECT user_id, type, settings FROM proxies")
+            for user_id, typ, settings in src:
+                proxies_by_user[user_id].append((typ, settings))
 
-        with pasarguard_conn.cursor() as cur:
-            cur.execute("SHOW TABLES LIKE 'users'")
-            if cur.fetchone() is None:
-                cur.execute("""
-                    CREATE TABLE users (
-                        id INT PRIMARY KEY, username VARCHAR(255) NOT NULL, status VARCHAR(50),
-                        used_traffic BIGINT, data_limit BIGINT, created_at DATETIME NOT NULL,
-                        admin_id INT, data_limit_reset_strategy VARCHAR(50), sub_revoked_at DATETIME,
-                        note TEXT, online_at DATETIME, edit_at DATETIME, on_hold_timeout DATETIME,
-                        on_hold_expire_duration INT, auto_delete_in_days INT,
-                        last_status_change DATETIME, expire DATETIME, proxy_settings JSON
-                    )
-                """)
-                print(f"{GREEN}Created users table in Pasarguard ✓{RESET}")
-                time.sleep(0.5)
+        with table_savepoint(pasarguard_conn, "users"), pasarguard_conn.cursor() as cur:
+            sql = build_insert_sql("users", USER_COLUMNS, fresh, supports_row_alias(pasarguard_conn))
 
-            for u in users:
+            def flush(batch: List[tuple]) -> int:
                 try:
-                    with marzban_conn.cursor() as pcur:
-                        pcur.execute("SELECT * FROM proxies WHERE user_id = %s", (u["id"],))
-                        proxies = pcur.fetchall()
-
-                    proxy_cfg = {}
-                    for p in proxies:
-                        s = json.loads(p["settings"])
-                        typ = p["type"].lower()
-                        if typ == "vmess":
-                            proxy_cfg["vmess"] = {"id": s.get("id")}
-                        elif typ == "vless":
-                            proxy_cfg["vless"] = {"id": s.get("id"), "flow": s.get("flow", "")}
-                        elif typ == "trojan":
-                            proxy_cfg["trojan"] = {"password": s.get("password")}
-                        elif typ == "shadowsocks":
-                            proxy_cfg["shadowsocks"] = {"password": s.get("password"), "method": s.get("method")}
-
-                    expire_dt = None
-                    if u["expire"]:
+                    cur.executemany(sql, batch)
+                    return len(batch)
+                except Exception:
+                    # One bad row rejects the whole multi-row INSERT; retry the batch row by row so only it is skipped.
+                    inserted = 0
+                    pending = batch
+                    if fresh:
+                        # pymysql may have split the batch at max_stmt_length, and the statements before the failing
+                        # one are already in. Plain INSERTs would hit duplicate keys on them, so leave those rows out.
+                        cur.execute(f"SELECT id FROM users WHERE id IN ({','.join(['%s'] * len(batch))})", [row[0] for row in batch])
+                        done = {r[0] for r in cur.fetchall()}
+                        inserted = len(done)
+                        pending = [row for row in batch if row[0] not in done]
+                    for row in pending:
                         try:
-                            expire_dt = datetime.datetime.fromtimestamp(u["expire"])
-                        except:
-                            pass
-
-                    used = u["used_traffic"] or 0
-
-                    cur.execute(
-                        """
-                        INSERT INTO users
-                        (id, username, status, used_traffic, data_limit, created_at,
-                         admin_id, data_limit_reset_strategy, sub_revoked_at, note,
-                         online_at, edit_at, on_hold_timeout, on_hold_expire_duration,
-                         auto_delete_in_days, last_status_change, expire, proxy_settings)
-                        VALUES (%s,%s,%s,%s,%s,%s,%s,%s,%s,%s,%s,%s,%s,%s,%s,%s,%s,%s)
-                        ON DUPLICATE KEY UPDATE
-                            username = %s, status = %s, used_traffic = %s, data_limit = %s,
-                            created_at = %s, admin_id = %s, data_limit_reset_strategy = %s,
-                            sub_revoked_at = %s, note = %s, online_at = %s, edit_at = %s,
-                            on_hold_timeout = %s, on_hold_expire_duration = %s,
-                            auto_delete_in_days = %s, last_status_change = %s,
-                            expire = %s, proxy_settings = %s
-                        """,
-                        (
-                            u["id"], u["username"], u["status"], used, u["data_limit"],
-                            u["created_at"], u["admin_id"], u["data_limit_reset_strategy"],
-                            u["sub_revoked_at"], u["note"], u["online_at"], u["edit_at"],
-                            u["on_hold_timeout"], u["on_hold_expire_duration"], u["auto_delete_in_days"],
-                            u["last_status_change"], expire_dt, json.dumps(proxy_cfg),
-                            u["username"], u["status"], used, u["data_limit"],
-                            u["created_at"], u["admin_id"], u["data_limit_reset_strategy"],
-                            u["sub_revoked_at"], u["note"], u["online_at"], u["edit_at"],
-                            u["on_hold_timeout"], u["on_hold_expire_duration"], u["auto_delete_in_days"],
-                            u["last_status_change"], expire_dt, json.dumps(proxy_cfg)
-                        ),
-                    )
-                    total_users += 1
-                except Exception as user_e:
-                    MIGRATION_SUMMARY_REPORT.append(f"{YELLOW}Warning: Failed to migrate user ID {u.get('id', 'Unknown')}: {str(user_e)}. Skipping this user.{RESET}")
-
-        pasarguard_conn.commit()
+                            cur.execute(sql, row)
+                            inserted += 1
+                        except Exception as user_e:
+                            MIGRATION_SUMMARY_REPORT.append(f"{YELLOW}Warning: Failed to migrate user ID {row[0]}: {str(user_e)}. Skipping this user.{RESET}")
+                    return inserted
+
+            def user_rows():
+                # Hot loop: bind lookups to locals once instead of resolving them per user
+                proxies_for = proxies_by_user.get
+                builder_for = PROXY_SETTINGS_BUILDERS.get
+                loads, dumps = json_loads, compact_json
+                fromtimestamp = datetime.datetime.fromtimestamp
+                with marzban_conn.cursor() as src:
+                    src.execute(f"SELECT {', '.join(USER_COLUMNS[:-1])} FROM users")
+                    for u in src:
+                        try:
+                            proxy_cfg = {}
+                            for typ, settings in proxies_for(u["id"], ()):
+                                typ = typ.lower()
+                                build = builder_for(typ)
+                                # Unsupported proxy types are skipped before their settings are parsed
+                                if build is not None:
+                                    proxy_cfg[typ] = build(loads(settings))
+
+                            exp = u["expire"]
+                            if isinstance(exp, datetime.datetime):
+                                expire_dt = exp
+                            elif isinstance(exp, (int, float)) and 0 < exp < MAX_EXPIRE_TIMESTAMP:
+                                expire_dt = fromtimestamp(exp)
+                            else:
+                                expire_dt = None
+
+                            used = u["used_traffic"] or 0
+
+                            yield (
+                                u["id"], u["username"], u["status"], used, u["data_limit"],
+                                u["created_at"], u["admin_id"], u["data_limit_reset_strategy"],
+                                u["sub_revoked_at"], u["note"], u["online_at"], u["edit_at"],
+                                u["on_hold_timeout"], u["on_hold_expire_duration"], u["auto_delete_in_days"],
+                                u["last_status_change"], expire_dt, dumps(proxy_cfg)
+                            )
+                        except Exception as user_e:
+                            MIGRATION_SUMMARY_REPORT.append(f"{YELLOW}Warning: Failed to migrate user ID {u.get('id', 'Unknown')}: {str(user_e)}. Skipping this user.{RESET}")
+
+            if load_data:
+                total_users = load_data_local(cur, "users", USER_COLUMNS, user_rows(), fresh)
+            else:
+                cur.max_stmt_length = stmt_length_limit(cur)
+                for batch in iter_batches(user_rows()):
+                    total_users += flush(batch)
     except Exception as e:
+        # Batches flushed before the failure were rolled back with the savepoint
+        total_users = 0
         MIGRATION_SUMMARY_REPORT.append(f"{YELLOW}Warning: Failed to migrate users table: {str(e)}. Skipping this table.{RESET}")
         
     return total_users
 
+def connect_pair(marzban_config: Dict[str, Any], pasarguard_config: Dict[str, Any]):
+    """Borrow a Marzban/Pasarguard connection pair; pymysql connections must not be shared between threads."""
+    return connect(marzban_config), connect(pasarguard_config)
+
+def run_phase_on_own_connections(marzban_config, pasarguard_config, phase, fresh: bool = False) -> int:
+    """Run one migrate_* phase on a dedicated connection pair and commit it on its own."""
+    global MIGRATION_SUMMARY_REPORT
+    marzban_conn, pasarguard_conn = connect_pair(marzban_config, pasarguard_config)
+    try:
+        if marzban_conn is None or pasarguard_conn is None:
+            return 0
+        if fresh:
+            set_bulk_checks(pasarguard_conn, False)
+        pasarguard_conn.begin()
+        count = phase(marzban_conn, pasarguard_conn)
+        pasarguard_conn.commit()
+        return count
+    except Exception as e:
+        pasarguard_conn.rollback()
+        MIGRATION_SUMMARY_REPORT.append(f"{RED}Failure: Parallel worker rolled back: {str(e)}{RESET}")
+        return 0
+    finally:
+        if fresh and pasarguard_conn is not None:
+            # Pooled connections are reused, so leave the session as it was found
+            try:
+                set_bulk_checks(pasarguard_conn, True)
+            except Exception:
+                pass
+        release_connection(marzban_config, marzban_conn)
+        release_connection(pasarguard_config, pasarguard_conn)
+
+def run_migration_phases(marzban_conn, pasarguard_conn, xray_config, fresh: bool = False, load_data: bool = False,
+                         worker_configs: Optional[Tuple[Dict[str, Any], Dict[str, Any]]] = None, jobs: int = 1,
+                         source_db: Optional[str] = None):
+    log("Ensuring default Pasarguard prerequisites...", flush=True)
+    ensure_default_group(pasarguard_conn)
+    ensure_default_core_config(pasarguard_conn)
+
+    def migrate_users():
+        # Users reference admins, so they only start once the admins phase has finished
+        log("Migrating users and proxy settings...", flush=True)
+        user_count = migrate_users_and_proxies(marzban_conn, pasarguard_conn, fresh, load_data)
+        log(f"{user_count} user(s) migrated (or skipped on error).", GREEN, flush=True)
+
+    # These phases only depend on the prerequisites above, so they may run side by side
+    independent_phases = []
+    if xray_config:
+        independent_phases.append(
+            ("Migrating xray_config.json to core_configs...", "Xray config migrated",
+             lambda m, p: migrate_xray_config(p, xray_config))
+        )
+    else:
+        log("Xray config migration skipped (Not found or manual mode).", YELLOW, flush=True)
+    admins_phase = lambda m, p: migrate_admins(m, p, fresh, load_data, source_db)
+    independent_phases += [
+        ("Migrating admins...", "admin(s) migrated", admins_phase),
+        ("Migrating inbounds...", "inbound(s) migrated and linked",
+         lambda m, p: migrate_inbounds_and_associate(m, p, fresh, load_data)),
+        ("Migrating hosts (with smart ALPN fix)...", "host(s) migrated",
+         lambda m, p: migrate_hosts(m, p, safe_alpn, fresh, load_data)),
+        ("Migrating nodes...", "node(s) migrated",
+         lambda m, p: migrate_nodes(m, p, fresh, load_data)),
+    ]
+    if worker_configs and jobs > 1:
+        # Workers write through their own connections, which only see the prerequisites once they are committed
+        pasarguard_conn.commit()
+        log(f"Migrating {len(independent_phases)} independent tables with {min(jobs, len(independent_phases))} parallel workers...", flush=True)
+        with ThreadPoolExecutor(max_workers=min(jobs, len(independent_phases))) as pool:
+            futures = []
+            for start_msg, done_msg, phase in independent_phases:
+                log(start_msg, flush=True)
+                futures.append(
+                    (pool.submit(run_phase_on_own_connections, worker_configs[0], worker_configs[1], phase, fresh), done_msg, phase)
+                )
+            # Users only wait for admins: they run on the main connection while the other workers keep copying
+            for future, done_msg, phase in futures:
+                if phase is admins_phase:
+                    log(f"{future.result()} {done_msg} (or skipped on error).", GREEN, flush=True)
+            pasarguard_conn.begin()
+            migrate_users()
+            for future, done_msg, phase in futures:
+                if phase is not admins_phase:
+                    log(f"{future.result()} {done_msg} (or skipped on error).", GREEN, flush=True)
+    else:
+        for start_msg, done_msg, phase in independent_phases:
+            log(start_msg, flush=True)
+            log(f"{phase(marzban_conn, pasarguard_conn)} {done_msg} (or skipped on error).", GREEN, flush=True)
+        migrate_users()
+
 # --- MENU LOGIC ---
+def write_file_atomic(path: str, content: bytes):
+    """Write content next to path and rename it into place, so a crash never leaves a truncated file."""
+    # A unique name in the same directory: no clash with a stale .tmp, and the rename stays on one filesystem
+    fd, tmp_path = tempfile.mkstemp(dir=os.path.dirname(path) or ".", prefix=os.path.basename(path) + ".")
+    try:
+        with os.fdopen(fd, 'wb') as file:
+            file.write(content)
+            file.flush()
+            # The data must be on disk before the rename, or a power loss can leave an empty file behind
+            os.fsync(file.fileno())
+        # Keep the original permissions and owner; the .env holds database credentials
+        st = os.stat(path)
+        os.chmod(tmp_path, st.st_mode & 0o7777)
+        os.chown(tmp_path, st.st_uid, st.st_gid)
+        os.replace(tmp_path, path)
+    except BaseException:
+        try:
+            os.unlink(tmp_path)
+        except OSError:
+            pass
+        raise
+
+def rewrite_port_lines(content: bytes, replacements: Iterable[Tuple[bytes, bytes]]) -> Optional[bytes]:
+    """Rewrite prefix<port> settings line by line with startswith-style checks, no regex involved.
+
+    Handles the usual compose layout, where each setting sits at the start of its own line (after the
+    indent and an optional "- " list marker). Returns None so the caller falls back to the regex pass
+    when a prefix is missing, shares a line with another setting, or appears mid-line.
+    """
+    replacements = tuple(replacements)
+    lines = content.split(b"\n")
+    found = set()
+    for i, line in enumerate(lines):
+        hits = [(prefix, new_port) for prefix, new_port in replacements if prefix in line]
+        if not hits:
+            continue
+        if len(hits) > 1:
+            return None
+        prefix, new_port = hits[0]
+        pos = line.find(prefix)
+        if line.count(prefix) > 1 or line[:pos].strip(b" \t-") or line[:pos].count(b"-") > 1:
+            return None
+        end = stop = pos + len(prefix)
+        while line[stop:stop + 1].isdigit():
+            stop += 1
+        if stop == end:
+            return None
+        lines[i] = line[:end] + new_port + line[stop:]
+        found.add(prefix)
+    if len(found) != len(replacements):
+        return None
+    return b"\n".join(lines)
+
+def parse_port(value: str) -> Optional[int]:
+    """Return value as a TCP port number, or None when it is not an integer in 1-65535."""
+    try:
+        port = int(value)
+    except ValueError:
+        return None
+    return port if 1 <= port <= 65535 else None
+
 def change_db_port() -> bool:
     clear_screen()
     print(f"{CYAN}=== Change Database and phpMyAdmin Ports (Pasarguard) ==={RESET}")
 
     default_db_port = "3307"
     default_apache_port = "8020"
-    db_port = input(f"Enter database port (Default: {default_db_port}): ").strip() or default_db_port
-    apache_port = input(f"Enter phpMyAdmin APACHE_PORT (Default: {default_apache_port}): ").strip() or default_apache_port
+    db_port = prompt(f"Enter database port (Default: {default_db_port}): ").strip() or default_db_port
+    apache_port = prompt(f"Enter phpMyAdmin APACHE_PORT (Default: {default_apache_port}): ").strip() or default_apache_port
     success = True
 
     try:
+        ports = []
         for port, name in [(db_port, "Database port"), (apache_port, "phpMyAdmin APACHE_PORT")]:
-            if not port.isdigit() or int(port) < 1 or int(port) > 65535:
+            parsed = parse_port(port)
+            if parsed is None:
                 print(f"{RED}Error: Invalid {name}. Must be between 1 and 65535.{RESET}")
                 success = False
-                input("Press Enter to return to the menu...")
+                prompt("Press Enter to return to the menu...")
                 return success
+            ports.append(parsed)
+        # Write the normalised numbers back, e.g. "+8020" or "08020" become "8020"
+        db_port, apache_port = (str(p) for p in ports)
+        db_port_b, apache_port_b = db_port.encode(), apache_port.encode()
 
+        changed = False
         env_file = PASARGUARD_ENV_PATH
         if os.path.exists(env_file):
-            with open(env_file, 'r', encoding='utf-8') as file:
-                content = file.read()
-            content = re.sub(r'DB_PORT=\d+', f'DB_PORT={db_port}', content, 1) if re.search(r'DB_PORT=\d+', content) else content + f'\nDB_PORT={db_port}\n'
-            
-            def replace_db_port(match):
-                return re.sub(r':\d+/', f':{db_port}/', match.group(0))
-
-            content = re.sub(
-                r'SQLALCHEMY_DATABASE_URL="mysql\+(asyncmy|pymysql)://([^:]+):([^@]+)@127\.0\.0\.1:\d+/[^"]+"',
-                replace_db_port,
-                content
-            )
-
-            with open(env_file, 'w', encoding='utf-8') as file:
-                file.write(content)
-            print(f"{GREEN}Updated {env_file} with database port {db_port} ✓{RESET}")
-            time.sleep(0.5)
+            with open(env_file, 'rb') as file:
+                content = original = file.read()
+            db_port_set = False
+
+            def replace_env_port(match):
+                nonlocal db_port_set
+                if match.group("db_port"):
+                    # Only the first DB_PORT is rewritten
+                    if db_port_set:
+                        return match.group(0)
+                    db_port_set = True
+                    return b'DB_PORT=' + db_port_b
+                return match.group("url_head") + db_port_b + match.group("url_tail")
+
+            content = _ENV_PORTS_RE.sub(replace_env_port, content)
+            if not db_port_set:
+                content += b'\nDB_PORT=' + db_port_b + b'\n'
+
+            # Re-entering the configured port leaves the file byte-identical; skip the write then
+            if content == original:
+                print(f"{CYAN}{env_file} already uses database port {db_port}; no change needed.{RESET}")
+            else:
+                write_file_atomic(env_file, content)
+                # A same-length port keeps the size, and coarse filesystem timestamps can keep the mtime,
+                # so drop the cached parse instead of relying on the (mtime, size) key
+                parse_env_file.cache_clear()
+                changed = True
+                print(f"{GREEN}Updated {env_file} with database port {db_port} ✓{RESET}")
+            if VERBOSE_PAUSE: time.sleep(VERBOSE_PAUSE)
         else:
             print(f"{RED}Error: File {env_file} not found. Pasarguard must be installed.{RESET}")
             success = False
 
         compose_file = DOCKER_COMPOSE_FILE_PATH
         if os.path.exists(compose_file):
-            with open(compose_file, 'r', encoding='utf-8') as file:
-                content = file.read()
-            
-            if re.search(r'--port=\d+', content):
-                content = re.sub(r'--port=\d+', f'--port={db_port}', content)
-            else:
-                content = re.sub(
-                    r'(command:\n\s+- --bind-address=127\.0\.0\.1)',
-                    f'command:\n      - --port={db_port}\n      - --bind-address=127.0.0.1',
-                    content
-                )
-            
-            if re.search(r'PMA_PORT: \d+', content):
-                content = re.sub(r'PMA_PORT: \d+', f'PMA_PORT: {db_port}', content)
-            else:
-                content = re.sub(
-                    r'(environment:\n\s+PMA_HOST: 127\.0\.0\.1)',
-                    f'environment:\n      PMA_HOST: 127.0.0.1\n      PMA_PORT: {db_port}',
-                    content
-                )
-            
-            if re.search(r'APACHE_PORT: \d+', content):
-                content = re.sub(r'APACHE_PORT: \d+', f'APACHE_PORT: {apache_port}', content)
+            with open(compose_file, 'rb') as file:
+                content = original = file.read()
+
+            # The common layout has one setting per line; only unusual files need the regex pass
+            swapped = rewrite_port_lines(
+                content, ((b'--port=', db_port_b), (b'PMA_PORT: ', db_port_b), (b'APACHE_PORT: ', apache_port_b))
+            )
+            if swapped is not None:
+                content = swapped
             else:
-                content = re.sub(
-                    r'(environment:\n\s+PMA_HOST: 127\.0\.0\.1\n\s+PMA_PORT: \d+)',
-                    f'environment:\n      PMA_HOST: 127.0.0.1\n      PMA_PORT: {db_port}\n      APACHE_PORT: {apache_port}',
-                    content
-                )
+                compose_ports = {"port": db_port_b, "pma_port": db_port_b, "apache_port": apache_port_b}
+                found = set()
+
+                def replace_compose_port(match):
+                    key = match.lastgroup
+                    found.add(key)
+                    return match.group(key) + compose_ports[key]
+
+                content = _COMPOSE_PORTS_RE.sub(replace_compose_port, content)
+
+                # Keys that were not present are inserted next to their neighbours; a substring test rules
+                # out a missing anchor without running the multi-line pattern
+                if "port" not in found and b'--bind-address=127.0.0.1' in content:
+                    content = _BIND_ADDR_RE.sub(
+                        b'command:\n      - --port=' + db_port_b + b'\n      - --bind-address=127.0.0.1',
+                        content
+                    )
+                if "pma_port" not in found and b'PMA_HOST: 127.0.0.1' in content:
+                    content = _PMA_HOST_RE.sub(
+                        b'environment:\n      PMA_HOST: 127.0.0.1\n      PMA_PORT: ' + db_port_b,
+                        content
+                    )
+                if "apache_port" not in found and b'PMA_PORT: ' in content:
+                    content = _PMA_HOST_PORT_RE.sub(
+                        b'environment:\n      PMA_HOST: 127.0.0.1\n      PMA_PORT: ' + db_port_b + b'\n      APACHE_PORT: ' + apache_port_b,
+                        content
+                    )
 
-            with open(compose_file, 'w', encoding='utf-8') as file:
-                file.write(content)
-            print(f"{GREEN}Updated {compose_file} with database port {db_port} and phpMyAdmin APACHE_PORT {apache_port} ✓{RESET}")
-            time.sleep(0.5)
+            if content == original:
+                print(f"{CYAN}{compose_file} already uses database port {db_port} and phpMyAdmin APACHE_PORT {apache_port}; no change needed.{RESET}")
+            else:
+                write_file_atomic(compose_file, content)
+                changed = True
+                print(f"{GREEN}Updated {compose_file} with database port {db_port} and phpMyAdmin APACHE_PORT {apache_port} ✓{RESET}")
+            if VERBOSE_PAUSE: time.sleep(VERBOSE_PAUSE)
         else:
             print(f"{RED}Error: File {compose_file} not found. Pasarguard must be installed.{RESET}")
             success = False
 
-        if success:
-            print(f"{GREEN}Port changes applied successfully! Please restart services:{RESET}")
-            print(f"  docker restart pasarguard-pasarguard-1")
-            print(f"  docker restart pasarguard-mariadb-1")
-            print(f"  docker restart pasarguard-phpmyadmin-1")
+        if success and not changed:
+            print(f"{GREEN}Ports are already configured; nothing to restart.{RESET}")
+        elif success:
+            # One write for the whole block; stdout is line-buffered at the menu and would flush per print
+            print(
+                f"{GREEN}Port changes applied successfully! Please restart services:{RESET}\n"
+                "  docker restart pasarguard-pasarguard-1\n"
+                "  docker restart pasarguard-mariadb-1\n"
+                "  docker restart pasarguard-phpmyadmin-1"
+            )
 
     except Exception as e:
         print(f"{RED}Error during port change: {str(e)}{RESET}")
         success = False
 
-    input("Press Enter to return to the menu...")
+    prompt("Press Enter to return to the menu...")
     return success
 
 def check_file_access(mode: str) -> bool:
@@ -684,9 +1352,13 @@ def check_file_access(mode: str) -> bool:
         (PASARGUARD_ENV_PATH, "Pasarguard .env"),
         (DOCKER_COMPOSE_FILE_PATH, "docker-compose.yml")
     ]
+    # os.access alone covers the common case: it fails for missing files too, so lexists only runs on failure
     for file_path, file_name in pasarguard_files:
-        if not os.path.exists(file_path) or not os.access(file_path, os.R_OK):
-            print(f"{RED}Critical Error: {file_name} is required at {file_path}. Please install Pasarguard first.{RESET}")
+        if not os.access(file_path, os.R_OK):
+            if os.path.lexists(file_path):
+                print(f"{RED}Critical Error: No read permission for {file_name} at {file_path}.{RESET}")
+            else:
+                print(f"{RED}Critical Error: {file_name} is required at {file_path}. Please install Pasarguard first.{RESET}")
             return False
 
     if mode == 'local':
@@ -695,22 +1367,25 @@ def check_file_access(mode: str) -> bool:
             (XRAY_CONFIG_PATH, "xray_config.json")
         ]
         for file_path, file_name in marzban_files:
-            if not os.path.exists(file_path) or not os.access(file_path, os.R_OK):
-                print(f"{YELLOW}Warning: Could not access {file_name} at {file_path}. Migration may fail or skip Xray config.{RESET}")
+            if not os.access(file_path, os.R_OK):
+                reason = "no read permission" if os.path.lexists(file_path) else "not found"
+                print(f"{YELLOW}Warning: Could not access {file_name} at {file_path} ({reason}). Migration may fail or skip Xray config.{RESET}")
     
     print(f"{GREEN}Pasarguard file access OK ✓{RESET}")
-    time.sleep(0.5)
+    if VERBOSE_PAUSE: time.sleep(VERBOSE_PAUSE)
     return success
 
 def get_marzban_config_mode() -> Tuple[Optional[Dict[str, Any]], Optional[Dict[str, Any]], Optional[Dict[str, Any]]]:
     global MIGRATION_SUMMARY_REPORT
     clear_screen()
-    print(f"{CYAN}=== Marzban Configuration Source ==={RESET}")
-    print("For migration, only Local File mode is supported.")
-    print("1. Local File: Load from /opt/marzban/.env (Marzban on the same server)")
-    print("2. Back to Main Menu")
+    print(
+        f"{CYAN}=== Marzban Configuration Source ==={RESET}\n"
+        "For migration, only Local File mode is supported.\n"
+        "1. Local File: Load from /opt/marzban/.env (Marzban on the same server)\n"
+        "2. Back to Main Menu"
+    )
     
-    choice = input("Enter your choice (1-2): ").strip()
+    choice = prompt("Enter your choice (1-2): ").strip()
     
     marzban_config = None
     pasarguard_config = None
@@ -728,14 +1403,16 @@ def get_marzban_config_mode() -> Tuple[Optional[Dict[str, Any]], Optional[Dict[s
         return None, None, None
     else:
         print(f"{RED}Invalid choice. Returning to Main Menu.{RESET}")
-        time.sleep(1)
+        # The caller waits for Enter before returning to the menu, so the message stays readable
+        if VERBOSE_PAUSE: time.sleep(VERBOSE_PAUSE)
         return None, None, None
     
     return marzban_config, pasarguard_config, xray_config
 
-def migrate_marzban_to_pasarguard():
+def migrate_marzban_to_pasarguard(fresh: bool = False, jobs: int = 1, load_data: bool = False):
     global MIGRATION_SUMMARY_REPORT
     MIGRATION_SUMMARY_REPORT = []
+    load_pymysql()
     clear_screen()
     print(f"{CYAN}=== Migrate Marzban to Pasarguard ==={RESET}")
 
@@ -744,7 +1421,7 @@ def migrate_marzban_to_pasarguard():
     if marzban_config is None or pasarguard_config is None:
         print(f"\n{RED}Migration aborted due to database configuration errors.{RESET}")
         print("\n" + "\n".join(MIGRATION_SUMMARY_REPORT))
-        input("Press Enter to return to the menu...")
+        prompt("Press Enter to return to the menu...")
         return False
     
     if (marzban_config['host'] == pasarguard_config['host'] and
@@ -752,105 +1429,207 @@ def migrate_marzban_to_pasarguard():
         marzban_config['db'] == pasarguard_config['db']):
         print(f"{RED}Error: Marzban and Pasarguard are using the exact same database. Aborting to prevent data corruption.{RESET}")
         MIGRATION_SUMMARY_REPORT.append(f"{RED}Failure: Same database detected for Marzban and Pasarguard.{RESET}")
-        input("Press Enter to return to the menu...")
+        prompt("Press Enter to return to the menu...")
         return False
 
-    print(f"{CYAN}Testing database connections...{RESET}")
-    marzban_conn = connect(marzban_config)
-    pasarguard_conn = connect(pasarguard_config)
+    # Both schemas on one server (the local install) let verbatim tables be copied without leaving it
+    source_db = None
+    if marzban_config['host'] == pasarguard_config['host'] and marzban_config['port'] == pasarguard_config['port']:
+        source_db = marzban_config['db']
+
+    if fresh:
+        print(f"{YELLOW}Fresh mode: existing Pasarguard admins, inbounds, hosts, nodes and users will be DELETED before importing.{RESET}")
+        print(f"{YELLOW}Other tables that reference them (e.g. users_groups_association) are NOT cleared and may be left "
+              f"with orphaned rows. The deletion cannot be undone, even if the import fails: take a backup first.{RESET}")
+        if prompt("Type 'yes' to continue: ").strip().lower() != "yes":
+            print(f"{RED}Migration cancelled.{RESET}")
+            prompt("Press Enter to return to the menu...")
+            return False
 
-    if marzban_conn is None or pasarguard_conn is None:
-        print(f"{RED}Migration aborted. Failed to connect to one or both databases.{RESET}")
-        print("\n" + "\n".join(MIGRATION_SUMMARY_REPORT))
-        if marzban_conn: marzban_conn.close()
-        if pasarguard_conn: pasarguard_conn.close()
-        input("Press Enter to return to the menu...")
-        return False
-    
-    print(f"{CYAN}============================================================{RESET}")
-    print(f"{CYAN}STARTING MIGRATION (Non-Fatal Errors will be logged as Warnings){RESET}")
-    print(f"{CYAN}============================================================{RESET}")
-    
-    print("Ensuring default Pasarguard prerequisites...")
-    ensure_default_group(pasarguard_conn)
-    ensure_default_core_config(pasarguard_conn)
+    print(f"{CYAN}Testing database connections...{RESET}")
+    # Cleanup runs in reverse order on every exit path: stdout buffering is restored, then both
+    # connections go back to the pool (release_connection ignores a failed, None connection)
+    with contextlib.ExitStack() as stack:
+        # Marzban is only read from: stream every result set row by row instead of buffering whole tables.
+        # Each streaming cursor must be drained before the next query on this connection.
+        marzban_config["cursorclass"] = pymysql.cursors.SSDictCursor
+        marzban_conn = connect(marzban_config)
+        stack.callback(release_connection, marzban_config, marzban_conn)
+        # The Pasarguard side is write-mostly; its few probes read positional tuples instead of building dicts
+        pasarguard_config["cursorclass"] = pymysql.cursors.Cursor
+        if load_data:
+            # Lets the client stream temp files for LOAD DATA LOCAL INFILE; only the Pasarguard side needs it
+            pasarguard_config["local_infile"] = True
+        pasarguard_conn = connect(pasarguard_config)
+        stack.callback(release_connection, pasarguard_config, pasarguard_conn)
+
+        if marzban_conn is None or pasarguard_conn is None:
+            print(f"{RED}Migration aborted. Failed to connect to one or both databases.{RESET}")
+            print("\n" + "\n".join(MIGRATION_SUMMARY_REPORT))
+            prompt("Press Enter to return to the menu...")
+            return False
 
-    print("Migrating admins...")
-    admin_count = migrate_admins(marzban_conn, pasarguard_conn)
-    print(f"{GREEN}{admin_count} admin(s) migrated (or skipped on error).{RESET}")
-    time.sleep(0.5)
+        # Block-buffer stdout while migrating: phase start/end lines flush explicitly so progress stays live,
+        # everything else (banners, the warning summary) goes out in a few large writes
+        if getattr(sys.stdout, "line_buffering", False) and hasattr(sys.stdout, "reconfigure"):
+            sys.stdout.reconfigure(line_buffering=False)
+            stack.callback(sys.stdout.reconfigure, line_buffering=True)
 
-    if xray_config:
-        print("Migrating xray_config.json to core_configs...")
-        migrate_count = migrate_xray_config(pasarguard_conn, xray_config)
-        print(f"{GREEN}{migrate_count} Xray config migrated (if 1 is correct).{RESET}")
-        time.sleep(0.5)
-    else:
-        print(f"{YELLOW}Xray config migration skipped (Not found or manual mode).{RESET}")
-        time.sleep(0.5)
-
-    print("Migrating inbounds...")
-    inbound_count = migrate_inbounds_and_associate(marzban_conn, pasarguard_conn)
-    print(f"{GREEN}{inbound_count} inbound(s) migrated and linked (or skipped on error).{RESET}")
-    time.sleep(0.5)
-
-    print("Migrating hosts (with smart ALPN fix)...")
-    host_count = migrate_hosts(marzban_conn, pasarguard_conn, safe_alpn)
-    print(f"{GREEN}{host_count} host(s) migrated (or skipped on error).{RESET}")
-    time.sleep(0.5)
-
-    print("Migrating nodes...")
-    node_count = migrate_nodes(marzban_conn, pasarguard_conn)
-    print(f"{GREEN}{node_count} node(s) migrated (or skipped on error).{RESET}")
-    time.sleep(0.5)
-
-    print("Migrating users and proxy settings...")
-    user_count = migrate_users_and_proxies(marzban_conn, pasarguard_conn)
-    print(f"{GREEN}{user_count} user(s) migrated (or skipped on error).{RESET}")
-    time.sleep(0.5)
-
-    print(f"{CYAN}============================================================{RESET}")
-    print(f"{GREEN}MIGRATION ATTEMPT COMPLETED!{RESET}")
-    print("Please restart Pasarguard and Xray services:")
-    print("  docker restart pasarguard-pasarguard-1")
-    print("  docker restart pasarguard-mariadb-1")
-    print("  docker restart xray")
-    print(f"{CYAN}============================================================{RESET}")
+        print(f"{CYAN}============================================================{RESET}")
+        print(f"{CYAN}STARTING MIGRATION (Non-Fatal Errors will be logged as Warnings){RESET}")
+        print(f"{CYAN}============================================================{RESET}")
     
-    if MIGRATION_SUMMARY_REPORT:
-        print(f"{YELLOW}SUMMARY OF WARNINGS/FAILURES:{RESET}")
-        for item in MIGRATION_SUMMARY_REPORT:
-            print(f"* {item}")
-    else:
-        print(f"{GREEN}No warnings or critical failures were logged. Appears successful!{RESET}")
+        existing_tables = load_existing_tables(pasarguard_conn)
+
+        print("Ensuring Pasarguard tables...")
+        ensure_pasarguard_tables(pasarguard_conn, existing_tables)
+
+        if fresh:
+            print("Clearing Pasarguard tables for a fresh import...")
+            try:
+                truncate_migrated_tables(pasarguard_conn, existing_tables)
+            except Exception as e:
+                # Earlier TRUNCATEs have already committed, so upserting into a half-cleared database is not an option
+                MIGRATION_SUMMARY_REPORT.append(f"{RED}Failure: Could not clear Pasarguard tables for --fresh: {str(e)}.{RESET}")
+                print(f"{RED}MIGRATION ABORTED! Some Pasarguard tables may already be cleared; restore them from your backup.{RESET}")
+                print("\n" + "\n".join(MIGRATION_SUMMARY_REPORT))
+                prompt("Press Enter to return to the menu...")
+                return False
+
+        dropped_indexes = {}
+        if fresh:
+            try:
+                dropped_indexes = drop_secondary_indexes(pasarguard_conn, existing_tables)
+            except Exception as e:
+                MIGRATION_SUMMARY_REPORT.append(f"{YELLOW}Warning: Could not defer secondary indexes: {str(e)}{RESET}")
+
+        # LOCAL loads coerce bad values instead of rejecting rows and lose the per-user error report,
+        # so LOAD DATA is only used on request
+        if load_data and not supports_local_infile(pasarguard_conn):
+            load_data = False
+            print(f"{YELLOW}Server has local_infile disabled; using multi-row INSERTs instead of LOAD DATA.{RESET}")
+
+        committed = False
+        checks_disabled = False
+        if fresh:
+            try:
+                # Only the emptied tables may skip per-row FK/unique validation: upserts merge into existing
+                # Pasarguard data, where a duplicate username or a dangling admin_id must still be rejected
+                set_bulk_checks(pasarguard_conn, False)
+                checks_disabled = True
+            except Exception as e:
+                MIGRATION_SUMMARY_REPORT.append(f"{YELLOW}Warning: Could not disable FK/unique checks on Pasarguard: {str(e)}{RESET}")
 
-    marzban_conn.close()
-    pasarguard_conn.close()
+        try:
+            # All phases write inside one transaction, so InnoDB flushes its log once for the whole migration
+            pasarguard_conn.begin()
+            run_migration_phases(
+                marzban_conn, pasarguard_conn, xray_config, fresh, load_data,
+                worker_configs=(marzban_config, pasarguard_config), jobs=jobs, source_db=source_db,
+            )
+            pasarguard_conn.commit()
+            committed = True
+        except Exception as e:
+            pasarguard_conn.rollback()
+            MIGRATION_SUMMARY_REPORT.append(f"{RED}Failure: Migration transaction rolled back: {str(e)}{RESET}")
+        finally:
+            # Runs after the COMMIT/ROLLBACK: rebuilding is DDL and must not end the data transaction early
+            restore_secondary_indexes(pasarguard_conn, dropped_indexes)
+            if checks_disabled:
+                set_bulk_checks(pasarguard_conn, True)
+
+        print(f"{CYAN}============================================================{RESET}")
+        if committed:
+            print(f"{GREEN}MIGRATION ATTEMPT COMPLETED!{RESET}")
+            print("Please restart Pasarguard and Xray services:")
+            print("  docker restart pasarguard-pasarguard-1")
+            print("  docker restart pasarguard-mariadb-1")
+            print("  docker restart xray")
+        else:
+            if fresh:
+                # The TRUNCATEs committed before the data transaction started, so the rollback cannot bring rows back
+                print(f"{RED}MIGRATION FAILED! --fresh already cleared the Pasarguard tables; restore them from your backup.{RESET}")
+            elif jobs > 1:
+                print(f"{RED}MIGRATION FAILED! Tables copied by parallel workers may already be committed.{RESET}")
+            else:
+                print(f"{RED}MIGRATION FAILED! No data was written to Pasarguard.{RESET}")
+        print(f"{CYAN}============================================================{RESET}")
+    
+        if MIGRATION_SUMMARY_REPORT:
+            print(f"{YELLOW}SUMMARY OF WARNINGS/FAILURES:{RESET}")
+            for item in MIGRATION_SUMMARY_REPORT:
+                print(f"* {item}")
+        else:
+            print(f"{GREEN}No warnings or critical failures were logged. Appears successful!{RESET}")
 
-    input("Press Enter to return to the menu...")
+    prompt("Press Enter to return to the menu...")
     return True
 
+def parse_args():
+    parser = argparse.ArgumentParser(
+        description="Migrate a Marzban panel to Pasarguard.",
+        epilog="Menu messages are printed without pauses. Use --verbose-pause, or set MARZ_PAUSE to a number "
+               "of seconds (e.g. MARZ_PAUSE=0.5), to pause after the port-change, file-access and invalid-choice "
+               "messages. The migration itself never pauses.",
+    )
+    parser.add_argument(
+        "--fresh",
+        action="store_true",
+        help="empty the migrated Pasarguard tables first and use plain INSERTs instead of upserts",
+    )
+    parser.add_argument(
+        "--load-data",
+        action="store_true",
+        help="load tables with LOAD DATA LOCAL INFILE instead of multi-row INSERTs (through a staging table "
+             "unless --fresh). Bad values are not reported per row; a table whose load raises warnings is skipped",
+    )
+    parser.add_argument(
+        "--jobs",
+        type=int,
+        default=1,
+        metavar="N",
+        help="copy the Xray config, admins, inbounds, hosts and nodes on up to N parallel connections (default: 1). "
+             "Users are copied on the main connection as soon as admins are done. "
+             "Each worker commits on its own, so a later failure no longer rolls back everything",
+    )
+    parser.add_argument(
+        "--verbose-pause",
+        type=pause_seconds,
+        default=VERBOSE_PAUSE,
+        metavar="SECONDS",
+        help="pause this long after the port-change, file-access and invalid-choice messages so they can be read "
+             "(default: MARZ_PAUSE or 0)",
+    )
+    return parser.parse_args()
+
+def exit_menu():
+    print(f"{CYAN}Exiting... Thank you for using Marz ➔ Pasarguard!{RESET}")
+    sys.exit(0)
+
 def main():
+    global VERBOSE_PAUSE
+    args = parse_args()
+    VERBOSE_PAUSE = args.verbose_pause
     if os.geteuid() != 0:
         print(f"{RED}This script must be run as root. Please run with sudo or as the root user.{RESET}")
         sys.exit(1)
         
     check_dependencies()
 
+    # Menu choice -> action; new entries only need a line here and in MENU_TEXT
+    actions = {
+        "1": change_db_port,
+        "2": lambda: migrate_marzban_to_pasarguard(fresh=args.fresh, jobs=args.jobs, load_data=args.load_data),
+        "3": exit_menu,
+    }
     while True:
         display_menu()
-        choice = input("Enter your choice (1-3): ").strip()
-
-        if choice == "1":
-            change_db_port()
-        elif choice == "2":
-            migrate_marzban_to_pasarguard()
-        elif choice == "3":
-            print(f"{CYAN}Exiting... Thank you for using Marz ➔ Pasarguard!{RESET}")
-            sys.exit(0)
+        action = actions.get(prompt("Enter your choice (1-3): ").strip())
+        if action is not None:
+            action()
         else:
             print(f"{RED}Invalid choice. Please enter 1, 2, or 3.{RESET}")
-            input("Press Enter to continue...")
+            prompt("Press Enter to continue...")
 
 if __name__ == "__main__":
     if sys.version_info < (3, 6):